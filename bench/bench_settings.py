@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmark for the config lookups done on every update.
+
+It compares what the handlers used to do (looking values up in the
+ConfigParser and converting them every time) with reading the compiled
+`Settings` snapshot.
+
+Run → `python3 bench/bench_settings.py`
+"""
+
+from configparser import ConfigParser, ExtendedInterpolation
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", "src"))
+
+import gatebot  # noqa: E402
+
+NUMBER = 100000
+
+config = ConfigParser(interpolation=ExtendedInterpolation())
+config.read(gatebot.config_file)
+settings = gatebot.load_settings(gatebot.config_file)
+chat_id = next(iter(settings.main_chats))
+
+
+def per_update_config() -> None:
+    # what new_status, start and GateButtons used to do per update.
+    chat_id in gatebot.parse_list(config["CHATS"]["main_chats"])
+    int(config["GENERAL"]["questions_count"])
+    int(config["GENERAL"]["correct_answers"])
+    config["GENERAL"]["delete_commands"] == "true"
+    config["STRINGS"]["correct_choice"]
+
+
+def per_update_settings() -> None:
+    chat_id in settings.main_chats
+    settings.questions_count
+    settings.correct_answers
+    settings.delete_commands
+    settings.strings["correct_choice"]
+
+
+def main() -> None:
+    results = {}
+    for func in (per_update_config, per_update_settings):
+        seconds = min(timeit.repeat(func, number=NUMBER, repeat=5))
+        results[func.__name__] = seconds / NUMBER * 1e6
+        print(f"{func.__name__:<22} {results[func.__name__]:8.3f} µs/update")
+    saved = results["per_update_config"] - results["per_update_settings"]
+    speedup = results["per_update_config"] / results["per_update_settings"]
+    print(f"{'saved':<22} {saved:8.3f} µs/update ({speedup:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
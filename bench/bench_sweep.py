@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark for the `check_if_user_start` sweep.
+
+It fills Redis with pending users who are all still within their deadline,
+and times one sweep, the way it used to be done (`HGETALL users:start` and
+checking every timestamp in Python) and with the `users:start:deadlines`
+sorted set. The new sweep should stay flat as the number of pending users
+grows.
+
+It needs a Redis server, and it only touches the keys it creates, in
+database 15 by default.
+
+Run → `python3 bench/bench_sweep.py --help`
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", "src"))
+
+import gatebot  # noqa: E402
+import redis  # noqa: E402
+
+
+class NullBot(object):
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+def old_sweep(rdb: redis.Redis, check_sent_start: int) -> int:
+    current_time = time.time()
+    expired: int = 0
+    for from_id, start_time in rdb.hgetall("users:start").items():
+        if not gatebot.is_digit(from_id) and not gatebot.is_digit(start_time):
+            continue
+        if current_time - int(float(start_time)) < check_sent_start:
+            continue
+        expired += 1
+    return expired
+
+
+def fill(rdb: redis.Redis, pending: int, check_sent_start: int) -> None:
+    now = time.time()
+    rdb.delete("users:start", "users:start:deadlines")
+    for first in range(0, pending, 10000):
+        chunk = range(first, min(first + 10000, pending))
+        rdb.hset("users:start", mapping={
+            user_id: now for user_id in chunk})
+        rdb.zadd("users:start:deadlines", {
+            user_id: now + check_sent_start for user_id in chunk})
+
+
+def timed(func, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def main() -> None:
+    gatebot.setup()
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--host", default=gatebot.settings.redis_host)
+    parser.add_argument("--port", type=int,
+                        default=gatebot.settings.redis_port)
+    parser.add_argument("--db", type=int, default=15)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    args = parser.parse_args()
+
+    rdb = redis.Redis(host=args.host, port=args.port, db=args.db)
+    gatebot.rdb = rdb
+    jobs = gatebot.GateJobs()
+    bot = NullBot()
+    check_sent_start = gatebot.settings.check_sent_start
+
+    print(f"{'pending':>8} {'HGETALL (ms)':>14} {'ZRANGEBYSCORE (ms)':>20}")
+    try:
+        for size in map(int, args.sizes.split(",")):
+            fill(rdb, size, check_sent_start)
+            old = timed(lambda: old_sweep(rdb, check_sent_start), args.repeat)
+            new = timed(lambda: jobs.has_sent_start(bot, None), args.repeat)
+            print(f"{size:>8} {old:>14.3f} {new:>20.3f}")
+    finally:
+        rdb.delete("users:start", "users:start:deadlines")
+
+
+if __name__ == "__main__":
+    main()
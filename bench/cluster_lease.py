@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Failover test for the leader lease of the cluster mode.
+
+It starts several processes competing for the same lease, like several
+processes of the bot would, then it kills the leader a few times and
+measures how long it takes for another process to take over. Every
+process logs when it thinks it's the leader, and at the end it checks
+that there never were two leaders at the same time.
+
+It needs a Redis server, and it only touches the keys it creates, in
+database 15 by default.
+
+Run → `python3 bench/cluster_lease.py --help`
+"""
+
+import argparse
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", "src"))
+
+import gatebot  # noqa: E402
+import redis  # noqa: E402
+
+LEASE_KEY: str = "bench:leader"
+LOG_KEY: str = "bench:leader:log"
+
+
+def member(args: argparse.Namespace, instance: str) -> None:
+    client = redis.Redis(host=args.host, port=args.port, db=args.db)
+    lease = gatebot.LeaderLease(client, LEASE_KEY, args.ttl, instance)
+    lease.start(args.renew)
+    while True:
+        if lease.is_leader:
+            client.rpush(LOG_KEY, f"{instance} {time.time()}")
+        time.sleep(0.05)
+
+
+def leader_terms(log: list) -> list:
+    """Every uninterrupted term of a leader, as (instance, start, end)."""
+    terms: list = []
+    for line in log:
+        instance, at = line.decode("utf-8").split()
+        if terms and terms[-1][0] == instance:
+            terms[-1][2] = float(at)
+        else:
+            terms.append([instance, float(at), float(at)])
+    return terms
+
+
+def main() -> None:
+    gatebot.setup()
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--host", default=gatebot.settings.redis_host)
+    parser.add_argument("--port", type=int,
+                        default=gatebot.settings.redis_port)
+    parser.add_argument("--db", type=int, default=15)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--kills", type=int, default=3)
+    parser.add_argument("--ttl", type=int, default=3)
+    parser.add_argument("--renew", type=int, default=1)
+    args = parser.parse_args()
+
+    client = redis.Redis(host=args.host, port=args.port, db=args.db)
+    client.delete(LEASE_KEY, LOG_KEY)
+    processes: dict = {}
+    for number in range(args.processes):
+        instance = f"member-{number}"
+        processes[instance] = multiprocessing.Process(
+            target=member, args=(args, instance), daemon=True)
+        processes[instance].start()
+
+    failovers: list = []
+    try:
+        for _ in range(args.kills):
+            leader = None
+            while leader is None:
+                leader = client.get(LEASE_KEY)
+                time.sleep(0.05)
+            leader = leader.decode("utf-8")
+            os.kill(processes.pop(leader).pid, signal.SIGKILL)
+            killed_at = time.time()
+            while client.get(LEASE_KEY) in (None, leader.encode("utf-8")):
+                time.sleep(0.05)
+            failovers.append(time.time() - killed_at)
+            print(f"killed {leader}, "
+                  f"new leader after {failovers[-1]:.2f}s")
+            if not processes:
+                break
+        terms = leader_terms(client.lrange(LOG_KEY, 0, -1))
+    finally:
+        for process in processes.values():
+            process.terminate()
+        client.delete(LEASE_KEY, LOG_KEY)
+
+    problems = [f"{first[0]} and {second[0]} were both leaders"
+                for first, second in zip(terms, terms[1:])
+                if second[1] <= first[2]]
+    if failovers:
+        print(f"failover: avg {sum(failovers) / len(failovers):.2f}s, "
+              f"max {max(failovers):.2f}s "
+              f"(ttl {args.ttl}s, renewed every {args.renew}s)")
+    for problem in problems[:20]:
+        print(problem)
+    print("FAIL" if problems else "OK")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+"""
+In-process stand-ins for Telegram and Redis, for the benchmarks.
+
+`FakeBot` records every API call instead of sending it, and `MemoryRedis`
+is a fakeredis server that runs the bot's real Lua scripts (it needs
+`fakeredis` and `lupa`).
+
+Both count what they were asked to do, and can wait a fixed round trip
+time on every call, to get numbers closer to a real deployment.
+"""
+
+from collections import Counter
+import itertools
+import re
+import os
+import sys
+import threading
+import time
+import types
+
+import fakeredis
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", "src"))
+
+import gatebot  # noqa: E402
+
+
+def ns(**kwargs) -> types.SimpleNamespace:
+    return types.SimpleNamespace(**kwargs)
+
+
+class FakeBot(object):
+    """
+    A bot that records its API calls by method, every call returns a
+    message-like object, and getChatAdministrators returns `admins`.
+    """
+
+    def __init__(self, rtt: float = 0.0, admins: tuple = ()):
+        self.id = 1
+        self.rtt = rtt
+        self.admins = admins
+        self.calls: Counter = Counter()
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+
+    @property
+    def total(self) -> int:
+        return sum(self.calls.values())
+
+    def get_chat_administrators(self, chat_id: int) -> list:
+        self._record("getChatAdministrators")
+        return [ns(user=ns(id=user_id)) for user_id in self.admins]
+
+    getChatAdministrators = get_chat_administrators
+
+    def _record(self, method: str) -> None:
+        with self._lock:
+            self.calls[method] += 1
+        if self.rtt:
+            time.sleep(self.rtt)
+
+    def __getattr__(self, name: str):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        method = "".join(part.capitalize() if i else part
+                         for i, part in enumerate(name.split("_")))
+
+        def call(*args, chat_id: int = 0, **kwargs):
+            self._record(method)
+            return ns(message_id=next(self._message_ids),
+                      chat=ns(id=chat_id), chat_id=chat_id)
+        # the name of the real method, the outbound queue limits by it.
+        call.__name__ = re.sub(r"(?<!^)(?=[A-Z])", "_", name).lower()
+        return call
+
+
+def message(bot: FakeBot, chat_id: int, user, **fields):
+    """A message from `user` in `chat_id`, `reply_text` goes to `bot`."""
+    attributes = {
+        "chat": ns(id=chat_id),
+        "chat_id": chat_id,
+        "from_user": user,
+        "message_id": next(bot._message_ids),
+        "left_chat_member": None,
+        "new_chat_members": [],
+        "reply_text": lambda text=None, **kwargs: bot.sendMessage(
+            chat_id=chat_id, text=text, **kwargs)}
+    attributes.update(fields)
+    return ns(**attributes)
+
+
+class FakeJobQueue(object):
+    """A job queue that keeps the jobs it's given until `run_pending`."""
+
+    def __init__(self):
+        self.pending: list = []
+        self._lock = threading.Lock()
+
+    def run_once(self, callback, when, context=None):
+        job = ns(context=context, interval=None,
+                 schedule_removal=lambda: None)
+        with self._lock:
+            self.pending.append((callback, job))
+        return job
+
+    def run_pending(self, bot: FakeBot) -> int:
+        with self._lock:
+            pending, self.pending = self.pending, []
+        for callback, job in pending:
+            callback(bot, job)
+        return len(pending)
+
+
+class MemoryRedis(object):
+    """
+    A Redis in memory: a fakeredis server, which runs the bot's real Lua
+    scripts with lupa. Every command (and every pipeline and script call)
+    is counted as one round trip, and can wait `rtt` seconds.
+
+    `peek()` runs a command without counting it, for checking the data
+    from the benchmarks themselves.
+    """
+
+    def __init__(self, rtt: float = 0.0):
+        self.rtt = rtt
+        self.client = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+        self.round_trips: int = 0
+        self.commands: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def round_trip(self, commands: list) -> None:
+        with self._lock:
+            self.round_trips += 1
+            self.commands.update(commands)
+        if self.rtt:
+            time.sleep(self.rtt)
+
+    def peek(self, command: str, *args, **kwargs):
+        return getattr(self.client, command)(*args, **kwargs)
+
+    def __getattr__(self, name: str):
+        method = getattr(self.client, name)
+
+        def command(*args, **kwargs):
+            self.round_trip([name])
+            return method(*args, **kwargs)
+        return command
+
+    def pipeline(self, transaction: bool = True) -> "MemoryPipeline":
+        return MemoryPipeline(self, self.client.pipeline(transaction))
+
+    def register_script(self, source: str) -> "MemoryScript":
+        return MemoryScript(self, self.client.register_script(source))
+
+    def scan_iter(self, match: str = None, count: int = None):
+        cursor = None
+        while cursor != 0:
+            self.round_trip(["scan"])
+            cursor, names = self.client.scan(cursor or 0, match, count)
+            yield from names
+
+
+class MemoryPipeline(object):
+    """The commands are queued, and sent in one round trip by `execute`."""
+
+    def __init__(self, client: MemoryRedis, pipe):
+        self.client = client
+        self.pipe = pipe
+        self.queued: list = []
+
+    def __len__(self) -> int:
+        return len(self.queued)
+
+    def __getattr__(self, name: str):
+        method = getattr(self.pipe, name)
+
+        def queue(*args, **kwargs):
+            self.queued.append(name)
+            method(*args, **kwargs)
+            return self
+        return queue
+
+    def execute(self) -> list:
+        queued, self.queued = self.queued, []
+        self.client.round_trip(queued)
+        return self.pipe.execute()
+
+
+class MemoryScript(object):
+    def __init__(self, client: MemoryRedis, script):
+        self.client = client
+        self.script = script
+
+    def __call__(self, keys: list = (), args: list = (), client=None):
+        client = self.client if client is None else client
+        if isinstance(client, MemoryPipeline):
+            client.queued.append("evalsha")
+            self.script(keys=keys, args=args, client=client.pipe)
+            return client
+        client.round_trip(["evalsha"])
+        return self.script(keys=keys, args=args, client=client.client)
+
+
+def install(redis_rtt: float = 0.0, api_rtt: float = 0.0,
+            admins: tuple = (), limits: bool = False) -> tuple:
+    """
+    This function sets the bot up, then points it at a new MemoryRedis,
+    with its scripts, and an outbound queue without rate limits, or with
+    the ones of `[LIMITS]` if `limits` is True.
+
+    returns: (FakeBot, MemoryRedis)
+    """
+    gatebot.setup()
+    memory = MemoryRedis(redis_rtt)
+    gatebot.rdb = memory
+    gatebot.ready_script = memory.register_script(gatebot.LUA_READY)
+    gatebot.navigate_script = memory.register_script(gatebot.LUA_NAVIGATE)
+    gatebot.answer_script = memory.register_script(gatebot.LUA_ANSWER)
+    gatebot.remember_users_script = memory.register_script(
+        gatebot.LUA_REMEMBER_USERS)
+    if limits:
+        gatebot.outbound = gatebot.OutboundQueue(
+            gatebot.settings.global_rate, gatebot.settings.chat_rate,
+            gatebot.settings.send_workers,
+            callback_rate=gatebot.settings.callback_rate)
+    else:
+        gatebot.outbound = gatebot.OutboundQueue(
+            1e9, 1e9, gatebot.settings.send_workers)
+    gatebot.admin_cache = gatebot.AdminCache(gatebot.settings.admin_cache_ttl)
+    gatebot.click_limiter = gatebot.ClickLimiter(
+        gatebot.settings.click_rate, gatebot.settings.click_burst,
+        memory if gatebot.settings.click_shared else None)
+    gatebot.session_nonces = gatebot.LRUCache(gatebot.session_nonces.maxsize)
+    gatebot.known_usernames = gatebot.LRUCache(
+        gatebot.known_usernames.maxsize)
+    return FakeBot(api_rtt, admins), memory
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Offline load test of the bot, without a bot token or a Redis server.
+
+It drives the real handlers, buttons, commands and jobs through a fake bot
+and an in-memory Redis (see `fakes.py`) with a few synthetic scenarios:
+
+* `join_raid`: raids of many members joining a main chat at once.
+* `quiz`: many users sending /start and clicking through the whole quiz
+  at the same time, on the bot's workers.
+* `flood`: a few users clicking the same quiz button as fast as they
+  can, most of the clicks are stopped by the per-user click limit.
+* `sweep`: the `check_if_user_start` job kicking lots of pending users.
+* `rss`: RSS polls of many feeds, with a few new entries every time.
+
+For every scenario it prints the operations per second, the p50/p99
+latency of one operation, and the Redis round trips, Redis commands and
+API calls per operation. `--save` saves the results as a baseline, and
+`--compare` compares them with one, it fails if anything got slower (or
+makes more calls) than the baseline, give or take `--tolerance`. The API
+calls aren't rate limited, unless `--real-limits` is given.
+
+Run → `python3 bench/load_test.py --help`
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import sys
+import threading
+import time
+
+from fakes import FakeJobQueue, gatebot, install, message, ns
+
+SCENARIOS: tuple = ("join_raid", "quiz", "flood", "sweep", "rss")
+FIRST_USER_ID: int = 10 ** 12
+
+
+class Recorder(object):
+    """The latencies of one scenario's operations."""
+
+    def __init__(self):
+        self.latencies: list = []
+        self._lock = threading.Lock()
+
+    def time(self, operation, *args, **kwargs):
+        started = time.perf_counter()
+        result = operation(*args, **kwargs)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.latencies.append(elapsed)
+        return result
+
+
+def percentile(values: list, percent: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def user(user_id: int):
+    return ns(id=user_id, username=f"user{user_id}",
+              first_name=f"User {user_id}", is_bot=False)
+
+
+def join_raid(bot, args: argparse.Namespace, recorder: Recorder) -> None:
+    handlers = gatebot.GateHandlers()
+    job_queue = FakeJobQueue()
+    chat_id = next(iter(gatebot.settings.main_chats))
+    user_ids = iter(range(FIRST_USER_ID, FIRST_USER_ID + 10 ** 9))
+    for _ in range(args.raids):
+        members = [user(next(user_ids)) for _ in range(args.raid_size)]
+        update = ns(message=message(bot, chat_id, members[0],
+                                    new_chat_members=members))
+        recorder.time(handlers.new_status, bot, update, job_queue)
+    job_queue.run_pending(bot)
+
+
+def click(buttons, bot, user_id: int, data) -> None:
+    query = ns(id=f"{user_id}", data=data.encode(), from_user=user(user_id),
+               message=ns(chat=ns(id=user_id), message_id=user_id))
+    buttons.diverter.__wrapped__(buttons, bot, ns(callback_query=query))
+
+
+def take_quiz(commands, buttons, bot, memory, recorder: Recorder,
+              user_id: int) -> None:
+    CallbackData = gatebot.CallbackData
+    recorder.time(commands.start, bot, ns(
+        message=message(bot, user_id, user(user_id))))
+    recorder.time(click, buttons, bot, user_id, CallbackData("r"))
+    question_ids = gatebot.decode_session(
+        memory.peek("get", f"user:questions:{user_id}"))
+    nonce = memory.peek("hget", f"user:{user_id}", "nonce").decode("utf-8")
+    for position, question_id in enumerate(question_ids):
+        answer = int(gatebot.quiz_bank[question_id]["answer"])
+        recorder.time(click, buttons, bot, user_id, CallbackData(
+            "a", nonce, position, question_id, answer))
+        recorder.time(click, buttons, bot, user_id, CallbackData("f", nonce))
+
+
+def quiz(bot, args: argparse.Namespace, recorder: Recorder) -> None:
+    commands = gatebot.GateCommands()
+    buttons = gatebot.GateButtons()
+    with ThreadPoolExecutor(max_workers=gatebot.settings.workers) as pool:
+        for future in [pool.submit(take_quiz, commands, buttons, bot,
+                                   gatebot.rdb, recorder, user_id)
+                       for user_id in range(FIRST_USER_ID,
+                                            FIRST_USER_ID + args.users)]:
+            future.result()
+
+
+def flood(bot, args: argparse.Namespace, recorder: Recorder) -> None:
+    commands = gatebot.GateCommands()
+    buttons = gatebot.GateButtons()
+    gatebot.settings = gatebot.settings._replace(
+        click_rate=args.click_rate, click_burst=args.click_burst)
+    gatebot.click_limiter = gatebot.ClickLimiter(
+        args.click_rate, args.click_burst,
+        gatebot.rdb if args.click_shared else None)
+
+    def hammer(user_id: int) -> None:
+        commands.start(bot, ns(message=message(bot, user_id, user(user_id))))
+        for _ in range(args.flood_clicks):
+            recorder.time(click, buttons, bot, user_id,
+                          gatebot.CallbackData("r"))
+
+    with ThreadPoolExecutor(max_workers=gatebot.settings.workers) as pool:
+        for future in [pool.submit(hammer, user_id)
+                       for user_id in range(FIRST_USER_ID,
+                                            FIRST_USER_ID + args.flooders)]:
+            future.result()
+
+
+def sweep(bot, args: argparse.Namespace, recorder: Recorder) -> None:
+    jobs = gatebot.GateJobs()
+    user_ids = iter(range(FIRST_USER_ID, FIRST_USER_ID + 10 ** 9))
+    for _ in range(args.rounds):
+        pending = [next(user_ids) for _ in range(args.pending)]
+        for user_id in pending:
+            gatebot.rdb.peek("hset", f"user:{user_id}", "username",
+                             f"user{user_id}")
+        gatebot.rdb.peek("zadd", "users:start:deadlines",
+                         {user_id: 0 for user_id in pending})
+        recorder.time(jobs.has_sent_start, bot, ns(context=None))
+
+
+def rss(bot, args: argparse.Namespace, recorder: Recorder) -> None:
+    jobs = gatebot.GateJobs(gatebot.RedisSeenStore(500))
+    feeds = [gatebot.Feed(feed_id, f"feed{feed_id}",
+                          f"https://example.com/{feed_id}.xml", 60, 0)
+             for feed_id in range(args.feeds)]
+    for feed in feeds:
+        feed.imported = True
+    for poll in range(args.polls):
+        for feed in feeds:
+            # every poll sees the latest 20 entries, 2 of them are new.
+            parsed = {"entries": [
+                {"id": f"{feed.name}:{number}",
+                 "link": f"https://example.com/{feed.name}/{number}",
+                 "title": f"Entry {number}"}
+                for number in range(poll * 2, poll * 2 + 20)]}
+            recorder.time(jobs.rss_reader, bot, feed, parsed)
+
+
+def run(name: str, args: argparse.Namespace) -> dict:
+    bot, memory = install(args.redis_rtt, args.api_rtt, admins=(1,),
+                          limits=args.real_limits)
+    gatebot.quiz_bank = gatebot.QuizBank([
+        {"question": f"Question {number}", "options": ["0", "1", "2", "3"],
+         "answer": number % 4} for number in range(args.bank)])
+    gatebot.settings = gatebot.settings._replace(
+        questions_count=args.questions,
+        correct_answers=args.questions,
+        join_window=10,
+        click_rate=0)
+    gatebot.join_greeter = gatebot.JoinGreeter(10)
+    recorder = Recorder()
+    started = time.perf_counter()
+    globals()[name](bot, args, recorder)
+    gatebot.outbound.drain()
+    elapsed = time.perf_counter() - started
+    operations = len(recorder.latencies)
+    return {"operations": operations,
+            "ops_per_sec": operations / elapsed,
+            "p50_ms": percentile(recorder.latencies, 50) * 1000,
+            "p99_ms": percentile(recorder.latencies, 99) * 1000,
+            "redis_round_trips_per_op": memory.round_trips / operations,
+            "redis_commands_per_op":
+                sum(memory.commands.values()) / operations,
+            "api_calls_per_op": bot.total / operations}
+
+
+def regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    found: list = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        if result["ops_per_sec"] < old["ops_per_sec"] * (1 - tolerance):
+            found.append(f"{name}: {result['ops_per_sec']:.0f} ops/s, "
+                         f"was {old['ops_per_sec']:.0f}")
+        if result["p99_ms"] > old["p99_ms"] * (1 + tolerance):
+            found.append(f"{name}: p99 {result['p99_ms']:.2f}ms, "
+                         f"was {old['p99_ms']:.2f}ms")
+        for metric in ("redis_round_trips_per_op", "redis_commands_per_op",
+                       "api_calls_per_op"):
+            if result[metric] > old[metric] + 0.01:
+                found.append(f"{name}: {metric} {result[metric]:.2f}, "
+                             f"was {old[metric]:.2f}")
+    return found
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("scenarios", nargs="*", default=SCENARIOS,
+                        help=f"any of {', '.join(SCENARIOS)} (all of them "
+                             f"by default)")
+    parser.add_argument("--users", type=int, default=10000,
+                        help="quiz takers")
+    parser.add_argument("--questions", type=int, default=20)
+    parser.add_argument("--bank", type=int, default=500,
+                        help="questions in the (generated) quiz bank")
+    parser.add_argument("--flooders", type=int, default=20,
+                        help="users clicking as fast as they can")
+    parser.add_argument("--flood-clicks", type=int, default=500,
+                        help="clicks of every flooder")
+    parser.add_argument("--click-rate", type=float, default=2)
+    parser.add_argument("--click-burst", type=int, default=5)
+    parser.add_argument("--click-shared", action="store_true",
+                        help="check the click limit in Redis too")
+    parser.add_argument("--raids", type=int, default=100)
+    parser.add_argument("--raid-size", type=int, default=100,
+                        help="members joining in one update")
+    parser.add_argument("--pending", type=int, default=5000,
+                        help="users kicked by every sweep")
+    parser.add_argument("--rounds", type=int, default=5,
+                        help="sweeps")
+    parser.add_argument("--feeds", type=int, default=50)
+    parser.add_argument("--polls", type=int, default=20)
+    parser.add_argument("--redis-rtt", type=float, default=0.0,
+                        help="seconds every Redis round trip takes")
+    parser.add_argument("--api-rtt", type=float, default=0.0,
+                        help="seconds every API call takes")
+    parser.add_argument("--real-limits", action="store_true",
+                        help="send the API calls within [LIMITS], instead "
+                             "of as fast as they come (the time to send "
+                             "them is in ops/s)")
+    parser.add_argument("--save", metavar="FILE",
+                        help="save the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare the results with a baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name}")
+
+    results: dict = {}
+    print(f"{'scenario':<10} {'ops':>8} {'ops/s':>9} {'p50 ms':>8} "
+          f"{'p99 ms':>8} {'RT/op':>7} {'cmd/op':>7} {'API/op':>7}")
+    for name in args.scenarios:
+        result = results[name] = run(name, args)
+        print(f"{name:<10} {result['operations']:>8} "
+              f"{result['ops_per_sec']:>9.0f} {result['p50_ms']:>8.3f} "
+              f"{result['p99_ms']:>8.3f} "
+              f"{result['redis_round_trips_per_op']:>7.2f} "
+              f"{result['redis_commands_per_op']:>7.2f} "
+              f"{result['api_calls_per_op']:>7.2f}")
+
+    if args.save:
+        with open(args.save, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+        print(f"Saved the baseline to {args.save}")
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            found = regressions(results, json.load(baseline_file),
+                                args.tolerance)
+        for regression in found:
+            print(f"REGRESSION {regression}")
+        print("FAIL" if found else "OK")
+        sys.exit(1 if found else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Test of the RSS polling against a local stub HTTP server.
+
+The server answers the same feed with a 200 and an ETag, then with a 304
+if the bot sent that ETag back, then with 500s. It checks that the bot
+sends If-None-Match, that a 304 yields no entries, and that the backoff
+grows with every failure.
+
+It doesn't need a bot token or Redis, only feedparser.
+
+Run → `python3 bench/rss_stub.py --help`
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", "src"))
+
+import gatebot  # noqa: E402
+
+ETAG: str = '"gatebot-stub-1"'
+BODY: bytes = b"""<?xml version="1.0"?>
+<rss version="2.0"><channel><title>Stub</title>
+<item><guid>stub:1</guid><title>First</title>
+<link>https://example.com/1</link></item>
+<item><guid>stub:2</guid><title>Second</title>
+<link>https://example.com/2</link></item>
+</channel></rss>"""
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers every GET with the next status of `server.statuses`."""
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        status = self.server.statuses.pop(0)
+        if status == 304 and self.headers.get("If-None-Match") != ETAG:
+            status = 200
+        self.send_response(status)
+        if status == 200:
+            self.send_header("ETag", ETAG)
+            self.send_header("Content-Type", "application/rss+xml")
+            self.send_header("Content-Length", str(len(BODY)))
+            self.end_headers()
+            self.wfile.write(BODY)
+        else:
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def poll(scheduler, feed) -> list:
+    """Polls the feed once, and returns what the handler got."""
+    handled: list = []
+    feed.next_run = 0
+    scheduler.poll(lambda feed, parsed: handled.append(parsed))
+    while feed.running:
+        time.sleep(0.01)
+    return handled
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--failures", type=int, default=3,
+                        help="500s in a row")
+    parser.add_argument("--interval", type=int, default=60)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.requests = []
+    server.statuses = [200, 304] + [500] * args.failures
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    feed = gatebot.Feed(0, "stub", f"http://127.0.0.1:{server.server_port}/",
+                        args.interval, 0)
+    scheduler = gatebot.FeedScheduler([feed], workers=1, timeout=5,
+                                      max_backoff=10 ** 6)
+    problems: list = []
+    try:
+        handled = poll(scheduler, feed)
+        if len(handled) != 1 or len(handled[0]["entries"]) != 2:
+            problems.append(f"200: got {handled!r}, not the 2 entries")
+        if feed.etag != ETAG:
+            problems.append(f"200: the ETag is {feed.etag!r}, not {ETAG}")
+
+        handled = poll(scheduler, feed)
+        sent = server.requests[-1].get("If-None-Match")
+        if sent != ETAG:
+            problems.append(f"304: If-None-Match was {sent!r}, not {ETAG}")
+        if handled:
+            problems.append(f"304: got {len(handled)} results, not none")
+        if feed.failures:
+            problems.append("304: counted as a failure")
+
+        backoffs: list = []
+        for _ in range(args.failures):
+            poll(scheduler, feed)
+            backoffs.append(feed.next_run - time.monotonic())
+        print("backoff after every 500: " +
+              ", ".join(f"{backoff:.0f}s" for backoff in backoffs))
+        if feed.failures != args.failures:
+            problems.append(f"500: {feed.failures} failures counted, "
+                            f"not {args.failures}")
+        if backoffs[0] <= args.interval:
+            problems.append(f"500: the backoff {backoffs[0]:.0f}s isn't "
+                            f"longer than the interval")
+        if any(later <= earlier
+               for earlier, later in zip(backoffs, backoffs[1:])):
+            problems.append("500: the backoff didn't grow")
+    finally:
+        server.shutdown()
+        scheduler.pool.shutdown()
+
+    for problem in problems:
+        print(problem)
+    print("FAIL" if problems else "OK")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Startup benchmark of the bot, without a bot token or a Redis server.
+
+Every run starts a new Python process, which imports the bot, builds it
+with `create_app()` (from a copy of `config.ini` with a made up token) and
+handles one `/start` through the dispatcher, with the fakes of
+`fakes.py`. It prints how long the import, building the app and the
+first update took, and the whole thing from starting the process, and
+whether feedparser was loaded (it shouldn't be, RSS is off).
+
+`--save` saves the results as a baseline, and `--compare` compares them
+with one, it fails if anything got slower than the baseline, give or
+take `--tolerance`.
+
+Run → `python3 bench/startup.py --help`
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE: str = os.path.dirname(os.path.realpath(__file__))
+STAGES: tuple = ("import", "app", "first_update", "total")
+
+
+def child(config: str) -> None:
+    started = time.perf_counter()
+    sys.path.insert(0, os.path.join(HERE, "..", "src"))
+    import gatebot
+    imported = time.perf_counter()
+    updater, _ = gatebot.create_app(config)
+    built = time.perf_counter()
+
+    from telegram import Update
+    from fakes import install
+    bot, _ = install()
+    bot.username = "GateBot"
+    update = Update.de_json({
+        "update_id": 1,
+        "message": {
+            "message_id": 1, "date": int(time.time()), "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+            "chat": {"id": 1000, "type": "private"},
+            "from": {"id": 1000, "is_bot": False, "first_name": "User",
+                     "username": "user1000"}}}, bot)
+    updater.dispatcher.process_update(update)
+    handled = time.perf_counter()
+    if bot.total != 1:
+        raise RuntimeError(f"/start made {bot.total} API calls, not 1")
+    print(json.dumps({"import": imported - started,
+                      "app": built - imported,
+                      "first_update": handled - built,
+                      "feedparser": "feedparser" in sys.modules}))
+
+
+def measure(config: str) -> dict:
+    started = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, os.path.realpath(__file__), "--child", config],
+        check=True, stdout=subprocess.PIPE, cwd=HERE).stdout
+    total = time.perf_counter() - started
+    result = json.loads(output.decode("utf-8").splitlines()[-1])
+    result["total"] = total
+    return result
+
+
+def test_config(directory: str) -> str:
+    sys.path.insert(0, os.path.join(HERE, "..", "src"))
+    import gatebot
+    with open(gatebot.config_file) as config_file:
+        lines = config_file.read().splitlines()
+    name = os.path.join(directory, "config.ini")
+    with open(name, "w") as config_file:
+        config_file.write("\n".join(
+            "bot_token: 123456:startup-benchmark"
+            if line.startswith("bot_token:") else line
+            for line in lines))
+    return name
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--save", metavar="FILE",
+                        help="save the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare the results with a baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--child", metavar="CONFIG", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        config = test_config(directory)
+        runs = [measure(config) for _ in range(args.runs)]
+    results = {stage: {"median_ms": statistics.median(
+                           run[stage] for run in runs) * 1000,
+                       "min_ms": min(run[stage] for run in runs) * 1000}
+               for stage in STAGES}
+    print(f"{'stage':<14} {'median ms':>10} {'min ms':>10}")
+    for stage in STAGES:
+        print(f"{stage:<14} {results[stage]['median_ms']:>10.1f} "
+              f"{results[stage]['min_ms']:>10.1f}")
+    loaded = any(run["feedparser"] for run in runs)
+    print(f"feedparser loaded: {'yes' if loaded else 'no'}")
+
+    if args.save:
+        with open(args.save, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+        print(f"Saved the baseline to {args.save}")
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        found = [f"{stage}: {results[stage]['median_ms']:.1f}ms, "
+                 f"was {baseline[stage]['median_ms']:.1f}ms"
+                 for stage in STAGES if stage in baseline and
+                 results[stage]["median_ms"] >
+                 baseline[stage]["median_ms"] * (1 + args.tolerance)]
+        for regression in found:
+            print(f"REGRESSION {regression}")
+        print("FAIL" if found else "OK")
+        sys.exit(1 if found else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Concurrency stress test for the quiz buttons.
+
+Many users take the quiz at the same time, every user on several threads
+at once (like double clicks handled by different workers), and then it
+checks that every user ended up with a consistent session, and that
+every message the bot edited belonged to the user who clicked.
+
+It needs a Redis server, and it only touches the keys it creates (the
+users' keys, and the quiz analytics of STATS_KEYS, which it deletes), in
+database 15 by default.
+
+Run → `python3 bench/stress_buttons.py --help`
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import os
+import sys
+import threading
+import time
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", "src"))
+
+import gatebot  # noqa: E402
+import redis  # noqa: E402
+
+FIRST_USER_ID: int = 10 ** 12
+
+
+class RecordingBot(object):
+    """A fake bot that only remembers which chats it edited messages in."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.edits: list = []
+        self.calls: int = 0
+
+    def editMessageText(self, chat_id, message_id, **kwargs):
+        with self.lock:
+            self.edits.append((chat_id, message_id))
+            self.calls += 1
+
+    def __getattr__(self, name):
+        def call(**kwargs):
+            with self.lock:
+                self.calls += 1
+        return call
+
+
+def click(buttons: gatebot.GateButtons, bot: RecordingBot, user_id: int,
+          data: str) -> None:
+    user = types.SimpleNamespace(id=user_id)
+    query = types.SimpleNamespace(
+        id=f"{user_id}:{data}",
+        data=data,
+        from_user=user,
+        message=types.SimpleNamespace(
+            chat=types.SimpleNamespace(id=user_id),
+            message_id=user_id))
+    # call the handler itself, without @run_async's dispatcher.
+    buttons.diverter.__wrapped__(
+        buttons, bot, types.SimpleNamespace(callback_query=query))
+
+
+def take_quiz(buttons: gatebot.GateButtons, bot: RecordingBot,
+              user_id: int, questions: int) -> None:
+    click(buttons, bot, user_id, gatebot.CallbackData("r").encode())
+    question_ids = gatebot.decode_session(
+        gatebot.rdb.get(f"user:questions:{user_id}"))
+    nonce = gatebot.rdb.hget(f"user:{user_id}", "nonce").decode("utf-8")
+    for position, question_id in enumerate(question_ids):
+        answer = int(gatebot.quiz_bank[question_id]["answer"])
+        click(buttons, bot, user_id, gatebot.CallbackData(
+            "a", nonce, position, question_id, answer).encode())
+        click(buttons, bot, user_id, gatebot.CallbackData(
+            "f", nonce).encode())
+
+
+def check_user(user_id: int, questions: int) -> list:
+    problems: list = []
+    state = gatebot.rdb.hgetall(f"user:{user_id}")
+    results = gatebot.rdb.hgetall(f"user:results:{user_id}")
+    if not 0 <= int(state[b"question"]) < questions:
+        problems.append(f"{user_id}: question {state[b'question']}")
+    answers = {position: value for position, value in results.items()
+               if position.isdigit()}
+    if len(answers) != questions or set(answers.values()) != {b"c"}:
+        problems.append(f"{user_id}: results {answers}")
+    counters = [int(results.get(name, -1))
+                for name in (b"answered", b"correct", b"wrong")]
+    if counters != [questions, questions, 0]:
+        problems.append(f"{user_id}: counters {counters}")
+    if not gatebot.rdb.sismember("users:allowed", user_id):
+        problems.append(f"{user_id}: not allowed")
+    return problems
+
+
+def main() -> None:
+    gatebot.setup()
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--host", default=gatebot.settings.redis_host)
+    parser.add_argument("--port", type=int,
+                        default=gatebot.settings.redis_port)
+    parser.add_argument("--db", type=int, default=15)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--clones", type=int, default=2,
+                        help="threads clicking for the same user")
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--questions", type=int, default=20)
+    args = parser.parse_args()
+
+    gatebot.rdb = redis.Redis(host=args.host, port=args.port, db=args.db)
+    gatebot.quiz_bank = gatebot.QuizBank([
+        {"question": f"Question {i}", "options": ["0", "1", "2", "3"],
+         "answer": i % 4} for i in range(args.questions * 5)])
+    # every click has to get through, without the per-user click limit.
+    gatebot.settings = gatebot.settings._replace(
+        questions_count=args.questions, correct_answers=args.questions,
+        click_rate=0)
+    gatebot.outbound = gatebot.OutboundQueue(1e9, 1e9, 8)
+    buttons = gatebot.GateButtons()
+    bot = RecordingBot()
+    user_ids = range(FIRST_USER_ID, FIRST_USER_ID + args.users)
+
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            for future in [pool.submit(take_quiz, buttons, bot, user_id,
+                                       args.questions)
+                           for user_id in user_ids
+                           for _ in range(args.clones)]:
+                future.result()
+        elapsed = time.perf_counter() - started
+        gatebot.outbound.drain()
+        problems = [problem for user_id in user_ids
+                    for problem in check_user(user_id, args.questions)]
+        problems += [f"{chat_id}: edited message {message_id}"
+                     for chat_id, message_id in bot.edits
+                     if chat_id != message_id]
+    finally:
+        gatebot.rdb.delete(*[f"{prefix}{user_id}" for user_id in user_ids
+                             for prefix in ("user:", "user:questions:",
+                                            "user:results:", "user:wait:")])
+        gatebot.rdb.srem("users:allowed", *user_ids)
+        gatebot.rdb.delete(*gatebot.STATS_KEYS)
+
+    clicks = args.users * args.clones * (1 + 2 * args.questions)
+    print(f"{clicks} clicks in {elapsed:.2f}s "
+          f"({clicks / elapsed:.0f} clicks/s), {args.workers} workers")
+    for problem in problems[:20]:
+        print(problem)
+    print("FAIL" if problems else "OK")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
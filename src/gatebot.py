@@ -11,26 +11,44 @@
 #############################################################################
 
 
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, error
+from telegram import CallbackQuery, InlineKeyboardButton
+from telegram import InlineKeyboardMarkup, error
 from telegram.ext import CommandHandler, Updater
 from telegram.ext import CallbackQueryHandler, MessageHandler, Filters
+from telegram.ext.dispatcher import run_async
 from telegram.bot import Bot
 from telegram.update import Update
+from telegram.utils.request import Request
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from configparser import ConfigParser, ExtendedInterpolation
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import MappingProxyType
+from typing import Mapping, NamedTuple
+from abc import ABC, abstractmethod
+from array import array
+from collections import OrderedDict
+import argparse
+import configparser
+import hashlib
+import html
 import random
 import re
 import os
 import logging
+import signal
+import socket
 import time
 import json
-import feedparser
 import redis
 import sys
+import threading
+import urllib.error
+import urllib.request
 
 
 # the reason why this is done, is to allow you to run the script anywhere
 # it's always a full path.
-path = os.path.dirname(os.path.realpath(sys.argv[0]))
+path = os.path.dirname(os.path.realpath(__file__))
 
 __author__ = "Mario"
 __copyright__ = "Copyright 2019, Mario || @dizaztor"
@@ -39,456 +57,3137 @@ __maintainer__ = "@dizaztor"
 __email__ = "mario@dizator.com"
 __version__ = "v0.2.0"
 
-config = ConfigParser(interpolation=ExtendedInterpolation())
-config.read(f"{path}/data/config.ini")
+config_file = f"{path}/data/config.ini"
 
 
-if config.sections() is []:
-    print("Are you sure the config file is there? \
-            This is read as an empty file!")
-    sys.exit(0)
+class Settings(NamedTuple):
+    """
+    An immutable, typed snapshot of `config.ini`.
+
+    It's compiled once by `load_settings()`, so the handlers don't have to
+    look up and convert the same config values on every update. Reloading
+    the config builds a new snapshot and swaps it in one go.
+    """
+    bot_token: str
+    workers: int
+    redis_host: str
+    redis_port: int
+    compact_interval: int
+    compact_batch: int
+    allow_rss: bool
+    rss_interval: int
+    rss_first: int
+    rss_workers: int
+    rss_timeout: int
+    rss_max_backoff: int
+    rss_seen_store: str
+    rss_seen_window: int
+    send_start_no: bool
+    delete_commands: bool
+    questions_count: int
+    correct_answers: int
+    test_delay: int
+    test_page_size: int
+    test_batch_size: int
+    test_max_range: int
+    quiz_reload_interval: int
+    quiz_stratify: str
+    check_if_user_start: bool
+    log_kick_no_start_user: bool
+    enable_webhook: bool
+    main_chats: frozenset
+    mods: frozenset
+    admin_cache_ttl: int
+    global_rate: float
+    chat_rate: float
+    callback_rate: float
+    send_workers: int
+    click_rate: float
+    click_burst: int
+    click_shared: bool
+    failed_user_wait: int
+    session_ttl: int
+    user_ttl: int
+    check_sent_start: int
+    check_sent_start_interval: int
+    check_sent_start_first: int
+    check_sent_start_batch: int
+    join_window: int
+    cluster: bool
+    cluster_instance: str
+    lease_ttl: int
+    lease_renew: int
+    metrics: bool
+    metrics_listen: str
+    metrics_port: int
+    commands: Mapping[str, str]
+    strings: Mapping[str, str]
+    webhook: Mapping[str, str]
+    rss: Mapping[str, str]
+    send_me_start: str
+
+
+# the commands and strings the bot uses, the commands default to their own
+# name if they're not in [COMMANDS], these strings have to be in [STRINGS],
+# the newer ones fall back to `string_defaults()`.
+COMMAND_NAMES: tuple = ("cancel", "config", "edit", "extra", "help", "lban",
+                        "remove", "start", "stats", "test", "version")
+STRING_NAMES: tuple = (
+    "user_took_quiz", "start_message", "no", "ready", "unknown_chat",
+    "new_member_bot", "send_me_start", "failed_match", "no_start",
+    "correct_choice", "wrong_choice", "already_chosen", "enough_correct",
+    "unanswered_questions", "has_to_wait")
+
+
+def string_defaults(commands: Mapping[str, str]) -> dict:
+    """
+    This function returns the strings older configs don't have, with the
+    given command names.
+
+    returns: dict
+    """
+    return {
+        "test_running": "Checking {count} questions in the background, "
+                        f"send /{commands['cancel']} to stop.",
+        "test_done": "Checked {count} questions, {problems} of them have "
+                     "problems.",
+        "test_cancelled": "Cancelled the test.",
+        "test_bank_changed": "The questions changed since this preview was "
+                             f"sent, send /{commands['test']} for a new one.",
+        "stale_button": "This button is from an old quiz, send "
+                        f"/{commands['start']} to get a new one.",
+        "too_many_clicks": "Slow down, you're clicking too fast."}
+
+
+def option(parser: ConfigParser, section: str, name: str, kind: str = "",
+           fallback=None):
+    """
+    This function reads one option of the config, converted by the
+    parser's `get{kind}()` (e.g. "int", "boolean"), or `fallback` if it's
+    not in the config.
+
+    raises: KeyError if it's not in the config and there's no fallback,
+    ValueError if it has the wrong type.
+
+    returns: the value of the option.
+    """
+    try:
+        value = getattr(parser, f"get{kind}")(section, name,
+                                              fallback=fallback)
+    except ValueError as err:
+        raise ValueError(f"[{section}] {name}: {err}") from err
+    if value is None:
+        raise KeyError(f"[{section}] {name} is missing")
+    return value
+
+
+def load_settings(file_name: str) -> Settings:
+    """
+    This function reads the given config file and compiles it into
+    a `Settings` snapshot, converting every value once.
+
+    The options that older versions didn't have fall back to their
+    defaults, every other option has to be there.
+
+    raises: FileNotFoundError if the file can't be read, KeyError or
+    ValueError if a value is missing or has the wrong type.
+
+    returns: Settings
+    """
+    parser = ConfigParser(interpolation=ExtendedInterpolation())
+    if not parser.read(file_name):
+        raise FileNotFoundError(file_name)
+
+    def get(section: str, name: str, kind: str = "", fallback=None):
+        return option(parser, section, name, kind, fallback)
+
+    correct_answers = get("GENERAL", "correct_answers", "int")
+    questions_count = get("GENERAL", "questions_count", "int")
+    if not 0 <= correct_answers <= questions_count or questions_count < 1:
+        raise ValueError("correct_answers has to be between 0 and "
+                         "questions_count, which has to be at least 1")
+    commands = {name: name for name in COMMAND_NAMES}
+    commands.update(parser["COMMANDS"])
+    strings = string_defaults(commands)
+    strings.update(parser["STRINGS"])
+    for name in STRING_NAMES:
+        if name not in strings:
+            raise KeyError(f"[STRINGS] {name} is missing")
+    quiz_stratify = get("GENERAL", "quiz_stratify", fallback="")
+    if quiz_stratify not in ("",) + QuizBank.STRATA:
+        raise ValueError(f"quiz_stratify can't be {quiz_stratify}")
+    failed_user_wait = get("USER", "failed_user_wait", "int")
+    session_ttl = get("USER", "session_ttl", "int", 604800)
+    user_ttl = get("USER", "user_ttl", "int", 2592000)
+    for name, value in (("failed_user_wait", failed_user_wait),
+                        ("session_ttl", session_ttl),
+                        ("user_ttl", user_ttl)):
+        if value < 1:
+            raise ValueError(f"{name} has to be at least 1 second")
+    global_rate = get("LIMITS", "global_rate", "float", 30.0)
+    chat_rate = get("LIMITS", "chat_rate", "float", 1.0)
+    callback_rate = get("LIMITS", "callback_rate", "float", 0.0)
+    send_workers = get("LIMITS", "send_workers", "int", 8)
+    if global_rate <= 0 or chat_rate <= 0:
+        raise ValueError("global_rate and chat_rate have to be more than 0")
+    if callback_rate < 0:
+        raise ValueError("callback_rate can't be negative")
+    if send_workers < 1:
+        raise ValueError("send_workers has to be at least 1")
+    click_rate = get("LIMITS", "click_rate", "float", 2.0)
+    click_burst = get("LIMITS", "click_burst", "int", 5)
+    if click_rate < 0:
+        raise ValueError("click_rate can't be negative")
+    if click_burst < 1:
+        raise ValueError("click_burst has to be at least 1")
+    webhook = dict(parser["WEBHOOK"])
+    webhook["port"] = get("WEBHOOK", "port", "int")
+    for name in ("key", "cert", "webhook_url"):
+        webhook[name] = webhook.get(name) or None
+    return Settings(
+        bot_token=get("BOT", "bot_token"),
+        workers=get("BOT", "workers", "int", 16),
+        redis_host=get("REDIS", "host"),
+        redis_port=get("REDIS", "port", "int"),
+        compact_interval=get("REDIS", "compact_interval", "int", 60),
+        compact_batch=get("REDIS", "compact_batch", "int", 1000),
+        allow_rss=get("GENERAL", "allow_rss", "boolean"),
+        rss_interval=get("GENERAL", "rss_interval", "int"),
+        rss_first=get("GENERAL", "rss_first", "int"),
+        rss_workers=get("GENERAL", "rss_workers", "int", 4),
+        rss_timeout=get("GENERAL", "rss_timeout", "int", 10),
+        rss_max_backoff=get("GENERAL", "rss_max_backoff", "int", 3600),
+        rss_seen_store=get("GENERAL", "rss_seen_store", fallback="redis"),
+        rss_seen_window=get("GENERAL", "rss_seen_window", "int", 500),
+        send_start_no=get("GENERAL", "send_start_no", "boolean"),
+        delete_commands=get("GENERAL", "delete_commands", "boolean"),
+        questions_count=questions_count,
+        correct_answers=correct_answers,
+        test_delay=get("GENERAL", "test_delay", "int"),
+        test_page_size=get("GENERAL", "test_page_size", "int", 5),
+        test_batch_size=get("GENERAL", "test_batch_size", "int", 50),
+        test_max_range=get("GENERAL", "test_max_range", "int", 500),
+        quiz_reload_interval=get("GENERAL", "quiz_reload_interval", "int",
+                                 10),
+        quiz_stratify=quiz_stratify,
+        check_if_user_start=get("GENERAL", "check_if_user_start", "boolean"),
+        log_kick_no_start_user=get("GENERAL", "log_kick_no_start_user",
+                                   "boolean"),
+        enable_webhook=get("GENERAL", "enable_webhook", "boolean"),
+        main_chats=frozenset(parse_list(get("CHATS", "main_chats"))),
+        mods=frozenset(parse_list(get("ADMINISTRATION", "mods"))),
+        admin_cache_ttl=get("ADMINISTRATION", "admin_cache_ttl", "int", 300),
+        global_rate=global_rate,
+        chat_rate=chat_rate,
+        callback_rate=callback_rate,
+        send_workers=send_workers,
+        click_rate=click_rate,
+        click_burst=click_burst,
+        click_shared=get("LIMITS", "click_shared", "boolean", False),
+        failed_user_wait=failed_user_wait,
+        session_ttl=session_ttl,
+        user_ttl=user_ttl,
+        check_sent_start=get("USER", "check_sent_start", "int"),
+        check_sent_start_interval=get("USER", "check_sent_start_interval",
+                                      "int"),
+        check_sent_start_first=get("USER", "check_sent_start_first", "int"),
+        check_sent_start_batch=get("USER", "check_sent_start_batch", "int",
+                                   100),
+        join_window=get("USER", "join_window", "int", 10),
+        commands=MappingProxyType(commands),
+        strings=MappingProxyType(strings),
+        cluster=get("CLUSTER", "enabled", "boolean", False),
+        cluster_instance=get("CLUSTER", "instance", fallback=""),
+        lease_ttl=get("CLUSTER", "lease_ttl", "int", 15),
+        lease_renew=get("CLUSTER", "lease_renew", "int", 5),
+        metrics=get("METRICS", "enabled", "boolean", False),
+        metrics_listen=get("METRICS", "listen", fallback="127.0.0.1"),
+        metrics_port=get("METRICS", "port", "int", 9464),
+        webhook=MappingProxyType(webhook),
+        rss=MappingProxyType(dict(parser["RSS"])),
+        send_me_start=strings["send_me_start"].format(
+            correct_answers=correct_answers,
+            questions_count=questions_count,
+            calc_percentage=f"{int((correct_answers/questions_count)*100)}"))
+
+
+logger = logging.getLogger(__name__)
+
+
+class AdminCache(object):
+    """
+    This class caches the administrators of every chat, keyed by chat ID.
+
+    Every entry lives for `ttl` seconds, after that, the next lookup will
+    refresh it with `getChatAdministrators()`. Only one thread refreshes a
+    chat at a time, the others wait for it and reuse its result, so a join
+    raid won't send the same API call over and over.
+
+    `hits` and `misses` count the API calls that were saved and made.
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._admins: dict = {}
+        self._locks: dict = {}
+        self._lock = threading.Lock()
+
+    def _fresh(self, chat_id: int):
+        entry = self._admins.get(chat_id)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        return None
+
+    def get(self, bot: Bot, chat_id: int) -> frozenset:
+        """
+        This method returns the IDs of the chat's administrators, calling
+        the API only if the cached list is missing or expired.
+
+        returns: frozenset
+        """
+        admins = self._fresh(chat_id)
+        if admins is None:
+            with self._lock:
+                chat_lock = self._locks.setdefault(chat_id, threading.Lock())
+            with chat_lock:
+                admins = self._fresh(chat_id)
+                if admins is None:
+                    self.misses += 1
+                    admins = frozenset(
+                        admin.user.id for admin in
+                        bot.get_chat_administrators(chat_id))
+                    self._admins[chat_id] = (time.monotonic() + self.ttl,
+                                             admins)
+                    return admins
+        self.hits += 1
+        return admins
+
+    def invalidate(self, chat_id: int = None) -> None:
+        """
+        This method drops the cached administrators of the given chat,
+        or of every chat if no chat_id is given.
+
+        returns: None
+        """
+        if chat_id is None:
+            self._admins.clear()
+        else:
+            self._admins.pop(chat_id, None)
+
+    def is_cached_admin(self, chat_id: int, user_id: int) -> bool:
+        """
+        This method checks the cache only, without calling the API.
+
+        returns: True or False
+        """
+        entry = self._admins.get(chat_id)
+        return entry is not None and user_id in entry[1]
+
+    def stats(self) -> dict:
+        """
+        This method returns the hit/miss counters of the cache.
+
+        returns: dict
+        """
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "chats": len(self._admins)}
+
+
+def is_admin(bot: Bot, update: Update, user_id: int) -> bool:
+    """
+    This function checks if the given user_id is an admin,
+    using the cached administrators list of the chat.
+
+    returns True or False.
+    """
+    return user_id in admin_cache.get(bot, update.message.chat.id)
+
+
+def is_mod(bot: Bot, user_id: int) -> bool:
+    """
+    This function checks if the given user_id can use the commands that
+    reach every main chat (e.g. `/lban all`), i.e. if it's one of the
+    `[ADMINISTRATION]` mods, or an admin of every main chat.
+
+    returns: True or False
+    """
+    if user_id in settings.mods:
+        return True
+    return bool(settings.main_chats) and all(
+        user_id in admin_cache.get(bot, chat_id)
+        for chat_id in settings.main_chats)
+
+
+def is_digit(obj: object) -> bool:
+    """
+    This functions checks if the given object is a digit.
+
+    returns: True or False
+    """
+    try:
+        int(float(obj))
+        return True
+    except ValueError:
+        return False
+
+
+def parse_rss(string: str) -> dict:
+    """
+    This function parses the RSS syntax string into a Python dictionary.
+
+    If `interval` is not provided, then it defaults to the [GENERAL] section.
+    rss_interval, which has the default value of 1200.
+
+    If `first` is not provided, then it defaults to the [GENERAL] section.
+    rss_first, which has the default value of 5.
+
+    returns: dict
+    """
+    parsed: dict = {}
+    for kv in string.split(","):
+        kv = kv.split("=")
+        key: str = kv[0]
+        value: str = kv[1]
+        if key == "link" and "reddit" in value:
+            value = f"https://www.reddit.com/r/{value.split(':')[1]}/.rss"
+        elif key == "interval" or key == "first":
+            value = int(value)
+        parsed[key] = value
+    if "interval" not in parsed:
+        parsed["interval"] = settings.rss_interval
+    if "first" not in parsed:
+        parsed["first"] = settings.rss_first
+    return parsed
+
+
+def parse_list(string: str, splitter: str = ",") -> list:
+    """
+    This function will parse the given string into a list,
+    separating values with a comma, however:
+
+    You can change that if you want with the splitter parameter.
+
+    it will use `is_digit()` to check if the current string is a digit,
+
+    if it is, then it will add it as a digit. That's it.
+
+    returns: list
+    """
+    return [int(i.strip()) if is_digit(i)
+            else i.strip() for i in string.split(splitter)]
+
+
+def decode_dict(obj: dict) -> dict:
+    """
+    This function simply parses a dict from the Redis database
+    and decode every value.
+
+    returns: dict
+    """
+    return {key.decode("utf-8"): val.decode("utf-8")
+            for key, val in obj.items()}
+
+
+def get_results(obj: dict) -> dict:
+    """
+    This function will give you the results from a dictionary.
+    For an example {"unanswered": 9, "correct": 2, "wrong": 2}
+    And it just does that, the button handler will do the rest.
+    E.g. see if the "correct" value is the same or bigger than the
+    one in the config file.
+
+    returns: dict
+    """
+    parsed = {"u": 0, "c": 0, "w": 0}
+    for value in obj.values():
+        parsed[value] += 1
+    return parsed
+
+
+class QuizBank(object):
+    """
+    This class holds the questions of `quizzes.json`, indexed by their ID,
+    which is their position in the file.
+
+    The questions are kept in columns (their texts, their options, and
+    their answers in an array), with the repeated strings shared, which is
+    a lot smaller than a dict per question. `__getitem__` makes the dict
+    of one question when it's needed. Questions that aren't usable (see
+    `check_question()`) are kept as they are, so `/test` can show what's
+    wrong with them, but they're never picked for a quiz.
+
+    Every bank has a `generation`, a hash of its file, so sessions keep
+    using the bank they were made with when the file changes, see
+    `session_bank()`.
+
+    Questions can also have a "category" and a "difficulty", `sample()`
+    can pick from every category (or difficulty) in proportion to how
+    many questions it has.
+
+    `render()` caches the text of every question the quiz shows, with the
+    bank, so a reloaded bank starts with an empty cache.
+
+    Every question also has a fingerprint, a 64-bit hash of its record as
+    it is in the file (not as `__getitem__` makes it, e.g. an answer of
+    "2" is 2 there), that's what the old JSON sessions stored.
+    """
+
+    STRATA: tuple = ("category", "difficulty")
+
+    def __init__(self, questions: list, generation: str = ""):
+        self.generation = generation
+        self._texts: list = []
+        self._options: list = []
+        self._answers = array("h")
+        self._fingerprints = array("Q")
+        self._labels: dict = {field: {} for field in self.STRATA}
+        self._broken: dict = {}
+        self._ids: dict = None
+        self._renders: dict = {}
+        self._usable = array("I")
+        self.strata: dict = {field: {} for field in self.STRATA}
+        strings: dict = {}
+        for question_id, question in enumerate(questions):
+            self._fingerprints.append(self.fingerprint(question))
+            if check_question(question) is not None:
+                self._broken[question_id] = question
+                self._texts.append("")
+                self._options.append(())
+                self._answers.append(-1)
+                continue
+            self._texts.append(question["question"])
+            self._options.append(tuple(strings.setdefault(option, option)
+                                       for option in question["options"]))
+            self._answers.append(int(question["answer"]))
+            self._usable.append(question_id)
+            for field in self.STRATA:
+                label = question.get(field)
+                if label is not None:
+                    label = strings.setdefault(str(label), str(label))
+                    self._labels[field][question_id] = label
+                self.strata[field].setdefault(
+                    label, array("I")).append(question_id)
+
+    @classmethod
+    def load(cls, file_name: str) -> "QuizBank":
+        """
+        This method loads the quiz bank from a `quizzes.json` file.
+
+        returns: QuizBank
+        """
+        with open(file_name, "rb") as quizzes_json:
+            raw = quizzes_json.read()
+        return cls(json.loads(raw)["quizzes"],
+                   hashlib.sha1(raw).hexdigest()[:8])
+
+    @staticmethod
+    def fingerprint(question: dict) -> int:
+        return int.from_bytes(hashlib.blake2b(
+            json.dumps(question, sort_keys=True).encode("utf-8"),
+            digest_size=8).digest(), "big")
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+    def __getitem__(self, question_id: int) -> dict:
+        if question_id in self._broken:
+            return self._broken[question_id]
+        question = {"question": self._texts[question_id],
+                    "options": list(self._options[question_id]),
+                    "answer": self._answers[question_id]}
+        for field in self.STRATA:
+            if question_id in self._labels[field]:
+                question[field] = self._labels[field][question_id]
+        return question
+
+    def find(self, question: dict) -> int:
+        """
+        This method finds the ID of a full question dict, as it was in the
+        file, it's only needed for sessions that still store the questions
+        themselves, so the index is only built the first time it's used.
+
+        returns: int, or None if the question isn't in the bank anymore.
+        """
+        return self._find(self.fingerprint(question))
+
+    def key(self, question_id: int) -> str:
+        """
+        This method returns the fingerprint of a question in hex, it's how
+        the quiz analytics count its answers, so they stay with it when
+        the file changes.
+
+        returns: str
+        """
+        return format(self._fingerprints[question_id], "016x")
+
+    def find_key(self, key: str) -> int:
+        """
+        This method finds the ID of a question by its `key()`.
+
+        returns: int, or None if the question isn't in the bank anymore.
+        """
+        try:
+            return self._find(int(key, 16))
+        except ValueError:
+            return None
+
+    def _find(self, fingerprint: int) -> int:
+        if self._ids is None:
+            self._ids = {fingerprint: question_id for question_id, fingerprint
+                         in enumerate(self._fingerprints)}
+        return self._ids.get(fingerprint)
+
+    def render(self, question_id: int, choice: str = "") -> tuple:
+        """
+        This method returns the text of a question as the quiz shows it,
+        with `choice` (e.g. "Correct!") under it if it's answered, and the
+        labels of its option buttons. It's only made the first time, then
+        it's cached by the question ID and the choice.
+
+        returns: (str, tuple of str)
+        """
+        key = (question_id, choice)
+        rendered = self._renders.get(key)
+        if rendered is None:
+            question = self[question_id]
+            labels = tuple(str(option_index) for option_index
+                           in range(len(question["options"])))
+            text = f"<code>(ID: {question_id})</code>\n" \
+                   f"{question['question']}\n" + \
+                   "".join(f"\n{label}) {option}" for label, option
+                           in zip(labels, question["options"]))
+            if choice:
+                text += f"\n\n<i>{choice}</i>"
+            rendered = self._renders[key] = (text, labels)
+        return rendered
+
+    def sample(self, count: int, stratify: str = "") -> list:
+        """
+        This method picks `count` random question IDs, out of the usable
+        questions. If `stratify` is "category" or "difficulty", every one
+        of them gets its share of the `count` questions (the remainders go
+        to the biggest fractions), otherwise it's a plain random sample.
+
+        Either way, it's O(count), not O(len(self)).
+
+        returns: list
+        """
+        if not stratify:
+            return random.sample(self._usable, count)
+        groups = self.strata[stratify]
+        shares = {label: count * len(ids) / len(self._usable)
+                  for label, ids in groups.items()}
+        quotas = {label: int(share) for label, share in shares.items()}
+        for label in sorted(shares, key=lambda label: quotas[label] -
+                            shares[label])[:count - sum(quotas.values())]:
+            quotas[label] += 1
+        question_ids: list = []
+        for label, quota in quotas.items():
+            question_ids += random.sample(groups[label], quota)
+        random.shuffle(question_ids)
+        return question_ids
+
+
+def encode_session(question_ids: list) -> str:
+    """
+    This function encodes the question IDs of a session the way they're
+    stored in `user:questions:{id}`, e.g. "3,17,42".
+
+    returns: str
+    """
+    return ",".join(map(str, question_ids))
+
+
+def decode_session(raw: bytes) -> list:
+    """
+    This function decodes the question IDs of a session stored with
+    `encode_session()`.
+
+    returns: list
+    """
+    return [int(question_id) for question_id in raw.split(b",")]
+
+
+def migrate_session(user_id: int, raw: bytes) -> list:
+    """
+    Sessions used to be stored as the JSON of the full questions, this
+    function converts one of them into question IDs and saves it.
+
+    If one of its questions isn't in the bank anymore, then the session
+    can't be converted, and it's dropped together with its results, so
+    the user gets a new one.
+
+    returns: list of question IDs, or None if the session was dropped.
+    """
+    name: str = f"user:questions:{user_id}"
+    question_ids = [quiz_bank.find(question) for question in json.loads(raw)]
+    if None in question_ids:
+        rdb.delete(name, f"user:results:{user_id}")
+        rdb.hset(f"user:{user_id}", "question", 0)
+        return None
+    rdb.set(name, encode_session(question_ids))
+    return question_ids
+
+
+def load_session(user_id: int) -> list:
+    """
+    This function returns the question IDs of the user's session,
+    converting the old JSON sessions on the fly.
+
+    returns: list, or None if the user has no session.
+    """
+    raw = rdb.get(f"user:questions:{user_id}")
+    if raw is None:
+        return None
+    if raw.startswith(b"["):
+        return migrate_session(user_id, raw)
+    return decode_session(raw)
+
+
+def migrate_pending_starts() -> None:
+    """
+    Users who haven't sent `/start` yet used to be kept in the `users:start`
+    hash with the time they joined, this function moves them into the
+    `users:start:deadlines` sorted set, scored by their deadline.
+
+    returns: None
+    """
+    pending = rdb.hgetall("users:start")
+    if not pending:
+        return
+    rdb.zadd("users:start:deadlines", {
+        int(from_id): float(start_time) + settings.check_sent_start
+        for from_id, start_time in pending.items()
+        if is_digit(from_id) and is_digit(start_time)})
+    rdb.delete("users:start")
+    logger.info("Moved %d pending users to users:start:deadlines",
+                len(pending))
+
+
+def migrate_sessions() -> None:
+    """
+    This function converts every old JSON session in the database into
+    question IDs. It only runs once, then it leaves a marker behind.
+    Sessions that are missed here are still converted by `load_session()`.
+
+    returns: None
+    """
+    if rdb.exists("migrations:sessions"):
+        return
+    migrated: int = 0
+    for name in rdb.scan_iter(match="user:questions:*", count=1000):
+        raw = rdb.get(name)
+        if raw is not None and raw.startswith(b"["):
+            migrate_session(int(name.rsplit(b":", 1)[1]), raw)
+            migrated += 1
+    rdb.set("migrations:sessions", 1)
+    logger.info("Converted %d quiz sessions to question IDs", migrated)
+
+
+USER_KEY = re.compile(
+    rb"^(user:|user:questions:|user:results:|user:wait:)(\d+)$")
+
+
+def key_prefix(name: bytes) -> str:
+    """
+    This function returns the prefix a key is counted under in the
+    keyspace report, which is everything before its last part, e.g.
+    "user:questions:*" for "user:questions:1234".
+
+    returns: str
+    """
+    head, colon, _ = name.decode("utf-8", "replace").rpartition(":")
+    return f"{head}:*" if colon else name.decode("utf-8", "replace")
+
+
+class KeyspaceCompactor(object):
+    """
+    This class goes through the whole database with `SCAN`, `batch` keys
+    every time `step()` is called, so it never blocks Redis for long.
+
+    The user keys from before they had TTLs get one: the sessions get
+    `session_ttl`, user:{id} gets `user_ttl` (if the user passed, they're
+    added to users:allowed first), and user:wait:{id}, which only had the
+    time the user failed, expires when the wait is over, and the failed
+    session is dropped.
+
+    It also counts the keys by prefix (see `key_prefix()`), and how many of
+    them have no TTL, `report` has the counts of the last full pass as
+    {prefix: (keys, keys without a TTL)}.
+    """
+
+    def __init__(self, batch: int):
+        self.batch = batch
+        self.cursor = 0
+        self.passes = 0
+        self.compacted = 0
+        self.report: dict = {}
+        self._counts: dict = {}
+
+    def step(self) -> None:
+        self.cursor, names = rdb.scan(self.cursor, count=self.batch)
+        pipe = rdb.pipeline(transaction=False)
+        for name in names:
+            pipe.ttl(name)
+        legacy: list = []
+        for name, ttl in zip(names, pipe.execute() if names else []):
+            counts = self._counts.setdefault(key_prefix(name), [0, 0])
+            counts[0] += 1
+            if ttl == -1:
+                counts[1] += 1
+                match = USER_KEY.match(name)
+                if match is not None:
+                    legacy.append(match.groups())
+        if legacy:
+            self.compact(legacy)
+        if self.cursor == 0:
+            self.passes += 1
+            self.report = {prefix: tuple(counts)
+                           for prefix, counts in self._counts.items()}
+            self._counts = {}
+            logger.info("Keyspace: %s", ", ".join(
+                f"{prefix} {keys} ({no_ttl} without TTL)"
+                for prefix, (keys, no_ttl) in sorted(
+                    self.report.items(), key=lambda item: -item[1][0])[:20]))
+
+    def compact(self, keys: list) -> None:
+        """
+        This method gives TTLs to the given user keys, as (prefix, user ID),
+        reading what it needs from them in one round trip first.
+
+        returns: None
+        """
+        pipe = rdb.pipeline(transaction=False)
+        for prefix, user_id in keys:
+            if prefix == b"user:wait:":
+                pipe.get(prefix + user_id)
+            elif prefix == b"user:":
+                pipe.hget(prefix + user_id, "allowed")
+        values = iter(pipe.execute())
+        now = time.time()
+        for prefix, user_id in keys:
+            name = prefix + user_id
+            if prefix == b"user:wait:":
+                try:
+                    remaining = float(next(values)) + \
+                        settings.failed_user_wait - now
+                except (TypeError, ValueError):
+                    remaining = 0
+                pipe.delete(b"user:questions:" + user_id,
+                            b"user:results:" + user_id)
+                if remaining > 0:
+                    pipe.expire(name, int(remaining) + 1)
+                else:
+                    pipe.delete(name)
+            elif prefix == b"user:":
+                if next(values) == b"true":
+                    pipe.sadd("users:allowed", user_id)
+                pipe.expire(name, settings.user_ttl)
+            else:
+                pipe.expire(name, settings.session_ttl)
+        pipe.execute()
+        self.compacted += len(keys)
+
+
+# The quiz analytics, kept by the quiz scripts as they go:
+# stats:questions = "{question key}:c" and "{question key}:w", how many
+# users answered every question right and wrong, by `QuizBank.key()`, so
+# the counts stay with their question when quizzes.json changes,
+# stats:results = "passed" and "failed", and for both of them how many
+# quizzes took up to every STATS_BUCKETS seconds ("passed:60", ...,
+# "passed:inf", not cumulative) and how many seconds they took in total
+# ("passed:seconds"),
+# stats:takers and stats:finishers = HyperLogLogs of the users who started
+# and finished a quiz.
+STATS_KEYS: tuple = ("stats:questions", "stats:results", "stats:takers",
+                     "stats:finishers")
+STATS_BUCKETS: tuple = (60, 120, 300, 600, 1200, 1800, 3600)
+
+# The quiz state transitions are Lua scripts, so every button press is one
+# atomic round trip. Every script takes the same keys:
+# KEYS[1] = user:questions:{id}, KEYS[2] = user:{id},
+# KEYS[3] = user:results:{id}, KEYS[4] = user:wait:{id},
+# KEYS[5] = users:allowed, KEYS[6] to KEYS[9] = STATS_KEYS
+# ARGV[1] is always the session nonce, and the last one is the ID of the
+# message the quiz is in, they return
+# {status, index, question_id, chosen, total, correct, wrong, nonce,
+#  changed}.
+# Besides the answer of every position, KEYS[3] holds running "answered",
+# "correct" and "wrong" counters, updated together with the answers, so
+# finishing a quiz doesn't have to count them.
+# The session keys expire after `[USER][session_ttl]`, and user:{id} after
+# `[USER][user_ttl]`, the users who passed are kept in users:allowed.
+# Failing a quiz drops its session and sets user:wait:{id}, which expires
+# when the user can take a new one.
+# The scripts also keep the analytics of every quiz, see STATS_KEYS, so
+# `/stats` doesn't have to look at the users' keys.
+# The page the quiz message shows (message ID, nonce, position and choice)
+# is kept in user:{id} too, "changed" is 0 if it's the same page as the
+# last time, so every process can skip the edit without asking Telegram.
+LUA_SESSION = """
+local message = ARGV[#ARGV]
+
+local function session(nonce)
+    local raw = redis.call("GET", KEYS[1])
+    if not raw then
+        return nil, "missing"
+    end
+    if string.sub(raw, 1, 1) == "[" then
+        return nil, "legacy"
+    end
+    local stored = redis.call("HGET", KEYS[2], "nonce")
+    if nonce ~= "" and stored and stored ~= nonce then
+        return nil, "stale"
+    end
+    local ids = {}
+    for question_id in string.gmatch(raw, "[^,]+") do
+        ids[#ids + 1] = tonumber(question_id)
+    end
+    return ids
+end
+
+local function render(status, ids, index, correct, wrong)
+    if index > #ids - 1 then
+        index = #ids - 1
+    end
+    if index < 0 then
+        index = 0
+    end
+    redis.call("HSET", KEYS[2], "question", index)
+    redis.call("HSETNX", KEYS[3], index, "u")
+    local chosen = redis.call("HGET", KEYS[3], index)
+    local nonce = redis.call("HGET", KEYS[2], "nonce") or ""
+    local page = message .. ":" .. nonce .. ":" .. index .. ":" .. chosen
+    local changed = 0
+    if redis.call("HGET", KEYS[2], "page") ~= page then
+        redis.call("HSET", KEYS[2], "page", page)
+        changed = 1
+    end
+    return {status, index, ids[index + 1], chosen, #ids,
+            correct or 0, wrong or 0, nonce, changed}
+end
+"""
+
+# ARGV[1] = the nonce of a new session, ARGV[2] = its question IDs, they're
+# only used if the user has no session yet, ARGV[3] = session_ttl,
+# ARGV[4] = user_ttl, ARGV[5] = the user ID, ARGV[6] = the message ID.
+# Users who failed have to wait
+# until user:wait:{id} expires.
+LUA_READY = LUA_SESSION + """
+if redis.call("EXISTS", KEYS[4]) == 1 then
+    return {"wait"}
+end
+if redis.call("SETNX", KEYS[1], ARGV[2]) == 1 then
+    redis.call("PFADD", KEYS[8], ARGV[5])
+    redis.call("HSET", KEYS[2], "nonce", ARGV[1], "question", 0)
+    redis.call("DEL", KEYS[3])
+    redis.call("HSET", KEYS[3], "answered", 0, "correct", 0, "wrong", 0)
+    redis.call("EXPIRE", KEYS[1], ARGV[3])
+    redis.call("EXPIRE", KEYS[3], ARGV[3])
+else
+    redis.call("HSETNX", KEYS[2], "nonce", ARGV[1])
+end
+redis.call("EXPIRE", KEYS[2], ARGV[4])
+local ids, status = session("")
+if not ids then
+    return {status}
+end
+local index = tonumber(redis.call("HGET", KEYS[2], "question")) or 0
+return render("ok", ids, index)
+"""
+
+# ARGV[2] = 1 (forward) or -1 (back), ARGV[3] = correct_answers,
+# ARGV[4] = the current time, ARGV[5] = failed_user_wait, ARGV[6] = the
+# user ID, ARGV[7] = the message ID. Going forward from the last question
+# finishes the quiz, and counts it in KEYS[7] with how long it took since
+# the nonce, in the first of STATS_BUCKETS it fits in. Going forward again
+# after passing only returns "finished".
+LUA_NAVIGATE = LUA_SESSION + """
+local function finish(status)
+    redis.call("HINCRBY", KEYS[7], status, 1)
+    redis.call("PFADD", KEYS[9], ARGV[6])
+    local nonce = redis.call("HGET", KEYS[2], "nonce") or ""
+    local started = tonumber(string.match(nonce, "^%x+") or "", 16)
+    if not started then
+        return
+    end
+    local seconds = math.max(0, tonumber(ARGV[4]) - started / 1000)
+    local bucket = "inf"
+    for _, le in ipairs({""" + ", ".join(map(str, STATS_BUCKETS)) + """}) do
+        if seconds <= le then
+            bucket = le
+            break
+        end
+    end
+    redis.call("HINCRBY", KEYS[7], status .. ":" .. bucket, 1)
+    redis.call("HINCRBY", KEYS[7], status .. ":seconds", math.floor(seconds))
+end
+
+local ids, status = session(ARGV[1])
+if not ids then
+    return {status}
+end
+local index = tonumber(redis.call("HGET", KEYS[2], "question")) or 0
+local target = index + tonumber(ARGV[2])
+if target < #ids then
+    return render("ok", ids, target)
+end
+local counts = redis.call("HMGET", KEYS[3], "answered", "correct", "wrong")
+local answered, correct, wrong
+if counts[1] then
+    answered = tonumber(counts[1])
+    correct, wrong = tonumber(counts[2]), tonumber(counts[3])
+else
+    -- a session from before the counters, count its answers once.
+    correct, wrong = 0, 0
+    for _, value in ipairs(redis.call("HVALS", KEYS[3])) do
+        if value == "c" then
+            correct = correct + 1
+        elseif value == "w" then
+            wrong = wrong + 1
+        end
+    end
+    answered = correct + wrong
+    redis.call("HSET", KEYS[3], "answered", answered,
+               "correct", correct, "wrong", wrong)
+end
+if answered < #ids then
+    status = "unanswered"
+elseif correct >= tonumber(ARGV[3]) then
+    if redis.call("HSETNX", KEYS[3], "finished", 1) == 1 then
+        status = "passed"
+        redis.call("SADD", KEYS[5], ARGV[6])
+        finish(status)
+    else
+        status = "finished"
+    end
+else
+    finish("failed")
+    local reply = render("failed", ids, index, correct, wrong)
+    redis.call("SET", KEYS[4], ARGV[4], "EX", ARGV[5], "NX")
+    redis.call("DEL", KEYS[1], KEYS[3])
+    return reply
+end
+return render(status, ids, index, correct, wrong)
+"""
+
+# ARGV[2] = the position of the question in the session, ARGV[3] = its
+# question ID, ARGV[4] = "c" or "w", ARGV[5] = its `QuizBank.key()`,
+# ARGV[6] = the message ID.
+LUA_ANSWER = LUA_SESSION + """
+local ids, status = session(ARGV[1])
+if not ids then
+    return {status}
+end
+local position = tonumber(ARGV[2])
+if ids[position + 1] ~= tonumber(ARGV[3]) then
+    return {"stale"}
+end
+status = "ok"
+local chosen = redis.call("HGET", KEYS[3], position)
+if chosen and chosen ~= "u" then
+    status = "already"
+else
+    redis.call("HSET", KEYS[3], position, ARGV[4])
+    redis.call("HINCRBY", KEYS[3], "answered", 1)
+    redis.call("HINCRBY", KEYS[3], ARGV[4] == "c" and "correct" or "wrong", 1)
+    redis.call("HINCRBY", KEYS[6], ARGV[5] .. ":" .. ARGV[4], 1)
+end
+local index = tonumber(redis.call("HGET", KEYS[2], "question")) or 0
+return render(status, ids, index)
+"""
+
+
+class QuizState(NamedTuple):
+    """
+    What a quiz state transition returns, i.e. everything that's needed
+    to render the user's current question.
+
+    `status` is "ok", or "missing"/"legacy" if the user has no usable
+    session, "stale" if the button is from another session, "wait" if the
+    user failed and can't start a new one yet, "already" for answers, and
+    "unanswered", "passed" or "failed" when trying to finish the quiz, or
+    "finished" if the user passed it already.
+
+    `changed` is False if the quiz message already shows this page.
+    """
+    status: str
+    index: int = 0
+    question_id: int = 0
+    chosen: str = "u"
+    total: int = 0
+    correct: int = 0
+    wrong: int = 0
+    nonce: str = ""
+    changed: bool = True
+
+    @classmethod
+    def parse(cls, reply: list) -> "QuizState":
+        if len(reply) == 1:
+            return cls(reply[0].decode("utf-8"))
+        status, index, question_id, chosen, total, correct, wrong, \
+            nonce, changed = reply
+        return cls(status.decode("utf-8"), index, question_id,
+                   chosen.decode("utf-8"), total, correct, wrong,
+                   nonce.decode("utf-8"), bool(changed))
+
+
+def new_nonce(bank: "QuizBank") -> str:
+    """
+    This function makes the nonce of a new quiz session. It's the time in
+    milliseconds, in hex, so the nonces of a user's sessions only go up,
+    and then the generation of the quiz bank its questions are from,
+    e.g. "18f2c3a9b10.3e9a1c07".
+
+    returns: str
+    """
+    nonce = format(time.time_ns() // 1000000, "x")
+    return f"{nonce}.{bank.generation}" if bank.generation else nonce
+
+
+def nonce_time(nonce: str) -> int:
+    """
+    This function returns the time part of a session nonce.
+
+    returns: int
+    """
+    return int(nonce.partition(".")[0], 16)
+
+
+CALLBACK_VERSION: str = "1"
+
+
+class CallbackData(NamedTuple):
+    """
+    The data of an inline button, encoded as
+    "{version}{action}{nonce}:{index}:{question}:{option}", e.g.
+    "1a16d2e7b3f0c:4:117:2" (answer option 2 of question 117, which is the
+    5th question of the session with that nonce).
+
+    The actions are in `GateButtons.actions`. For the `/test` pages, the
+    nonce is the range of the test ("{start}-{end}"), index is the page and
+    question is the ID of the admin who sent the `/test`.
+    """
+    action: str
+    nonce: str = ""
+    index: int = 0
+    question: int = 0
+    option: int = 0
+
+    def encode(self) -> str:
+        return f"{CALLBACK_VERSION}{self.action}{self.nonce}:{self.index}:" \
+               f"{self.question}:{self.option}"
+
+    @classmethod
+    def decode(cls, data: str) -> "CallbackData":
+        """
+        This method decodes the data of a button, buttons from before
+        there was a version in their data are decoded too.
+
+        returns: CallbackData, or None if it's not a button of this bot.
+        """
+        if data[:1] != CALLBACK_VERSION:
+            return cls.decode_legacy(data)
+        try:
+            head, index, question, option = data[2:].split(":")
+            return cls(data[1], head, int(index), int(question), int(option))
+        except ValueError:
+            return None
+
+    @classmethod
+    def decode_legacy(cls, data: str) -> "CallbackData":
+        parts: list = data.split(":")
+        try:
+            if data == "ready":
+                return cls("r")
+            elif data == "forward":
+                return cls("f")
+            elif data == "back":
+                return cls("b")
+            elif data == "ok_cool":
+                return cls("n")
+            elif parts[0] == "answer" and len(parts) == 4:
+                return cls("a", "", int(parts[1]), int(parts[2]),
+                           int(parts[3]))
+            elif parts[0] == "answer" and len(parts) == 3:
+                return cls("a", "", int(parts[1]), -1, int(parts[2]))
+            elif parts[0] == "test" and len(parts) == 4:
+                return cls("t", f"{parts[1]}-{parts[2]}", int(parts[3]))
+        except ValueError:
+            pass
+        return None
+
+
+def run_quiz_script(script: redis.client.Script, user_id: int,
+                    args: list) -> QuizState:
+    """
+    This function runs one of the quiz state transition scripts for the
+    given user. Old JSON sessions are converted first, and then it's run
+    again.
+
+    returns: QuizState
+    """
+    keys: list = [f"user:questions:{user_id}",
+                  f"user:{user_id}",
+                  f"user:results:{user_id}",
+                  f"user:wait:{user_id}",
+                  "users:allowed", *STATS_KEYS]
+    state = QuizState.parse(script(keys=keys, args=args, client=rdb))
+    if state.status == "legacy":
+        load_session(user_id)
+        state = QuizState.parse(script(keys=keys, args=args, client=rdb))
+    return state
+
+
+class Feed(object):
+    """
+    This class holds the state of one RSS feed from the [RSS] section:
+    when it's due next, the validators of its last response (for
+    conditional requests) and how many times in a row it failed.
+    """
+
+    def __init__(self, feed_id: int, name: str, link: str,
+                 interval: int, first: int):
+        self.id = feed_id
+        self.name = name
+        self.link = link
+        self.interval = interval
+        self.next_run: float = time.monotonic() + first
+        self.etag: str = None
+        self.modified: str = None
+        self.failures: int = 0
+        self.running: bool = False
+        self.imported: bool = False
+
+
+def fetch_feed(feed: Feed, timeout: float) -> dict:
+    """
+    This function downloads and parses an RSS feed. It sends the ETag and
+    Last-Modified of the last response, so the server can just say that
+    nothing changed. feedparser is only imported here, so it's not loaded
+    at all when RSS is disabled.
+
+    raises: OSError (including urllib's errors) if the request fails.
+
+    returns: feedparser.FeedParserDict, or None if the feed didn't change.
+    """
+    request = urllib.request.Request(
+        feed.link, headers={"User-Agent": f"GateBot/{__version__}"})
+    if feed.etag:
+        request.add_header("If-None-Match", feed.etag)
+    if feed.modified:
+        request.add_header("If-Modified-Since", feed.modified)
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            body = response.read()
+            feed.etag = response.headers.get("ETag")
+            feed.modified = response.headers.get("Last-Modified")
+    except urllib.error.HTTPError as err:
+        if err.code == 304:
+            return None
+        raise
+    import feedparser
+    return feedparser.parse(body)
+
+
+class FeedScheduler(object):
+    """
+    This class polls every RSS feed from one job, instead of having a job
+    per feed. The feeds that are due are downloaded concurrently, on a pool
+    of `workers` threads, so a slow feed doesn't hold the job queue.
+
+    A feed that fails is retried with an exponential backoff, which is
+    capped at `max_backoff` seconds.
+    """
+
+    def __init__(self, feeds: list, workers: int, timeout: float,
+                 max_backoff: int):
+        self.feeds = feeds
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def poll(self, handle) -> None:
+        """
+        This method starts downloading every feed that's due, `handle` is
+        then called with the feed and the parsed result, in the pool.
+
+        returns: None
+        """
+        now = time.monotonic()
+        for feed in self.feeds:
+            if not feed.running and feed.next_run <= now:
+                feed.running = True
+                self.pool.submit(self._poll_one, feed, handle)
+
+    def _poll_one(self, feed: Feed, handle) -> None:
+        try:
+            parsed = fetch_feed(feed, self.timeout)
+            if parsed is not None:
+                handle(feed, parsed)
+            feed.failures = 0
+            feed.next_run = time.monotonic() + feed.interval
+        except Exception as err:
+            feed.failures += 1
+            backoff = min(feed.interval * 2 ** feed.failures,
+                          max(self.max_backoff, feed.interval))
+            feed.next_run = time.monotonic() + backoff
+            logger.warning("RSS feed %s failed %d time(s), retrying in %ds: "
+                           "%r", feed.name, feed.failures, backoff, err)
+        finally:
+            feed.running = False
+
+
+def entry_key(entry: dict) -> str:
+    """
+    This function returns the key an RSS entry is remembered by, a hash of
+    its GUID, or its link if it doesn't have one, so re-titled entries
+    aren't posted again.
+
+    returns: str
+    """
+    identity = entry.get("id") or entry.get("link") or entry.get("title", "")
+    return hashlib.sha1(identity.encode("utf-8")).hexdigest()[:16]
+
+
+class SeenStore(ABC):
+    """
+    This is the base class for where the RSS reader remembers the entries
+    it already posted, per feed. Only the last `window` entries of every
+    feed are kept.
+    """
+
+    def __init__(self, window: int):
+        self.window = window
+
+    @abstractmethod
+    def seen(self, feed_name: str, keys: list) -> list:
+        """
+        This method checks which of the given entry keys were seen before.
+
+        returns: list of True or False, one per key.
+        """
+
+    @abstractmethod
+    def add(self, feed_name: str, keys: list) -> None:
+        """
+        This method remembers the given entry keys.
+
+        returns: None
+        """
+
+
+class MemorySeenStore(SeenStore):
+    """
+    A `SeenStore` that's kept in memory, it's forgotten on restart.
+    """
+
+    def __init__(self, window: int):
+        super().__init__(window)
+        self._feeds: dict = {}
+
+    def seen(self, feed_name: str, keys: list) -> list:
+        feed = self._feeds.get(feed_name, {})
+        return [key in feed for key in keys]
+
+    def add(self, feed_name: str, keys: list) -> None:
+        feed = self._feeds.setdefault(feed_name, OrderedDict())
+        for key in keys:
+            feed[key] = None
+            feed.move_to_end(key)
+        while len(feed) > self.window:
+            feed.popitem(last=False)
+
+
+class RedisSeenStore(SeenStore):
+    """
+    A `SeenStore` that's kept in Redis, in the `rss:seen:{feed}` sorted
+    sets, scored by the time the entries were seen.
+    """
+
+    def seen(self, feed_name: str, keys: list) -> list:
+        pipe = rdb.pipeline(transaction=False)
+        for key in keys:
+            pipe.zscore(f"rss:seen:{feed_name}", key)
+        return [score is not None for score in pipe.execute()]
+
+    def add(self, feed_name: str, keys: list) -> None:
+        if not keys:
+            return
+        name: str = f"rss:seen:{feed_name}"
+        now = time.time()
+        pipe = rdb.pipeline()
+        pipe.zadd(name, {key: now for key in keys})
+        pipe.zremrangebyrank(name, 0, -self.window - 1)
+        pipe.execute()
+
+
+SEEN_STORES: dict = {"redis": RedisSeenStore, "memory": MemorySeenStore}
+
+
+def import_seen_file(store: SeenStore, feed: Feed, entries: list) -> None:
+    """
+    The RSS reader used to remember the titles of the entries it posted in
+    `data/rss/{name}_rss.txt`, this function marks the current entries with
+    those titles as seen, and then renames the file to `.imported`.
+
+    returns: None
+    """
+    for file_name in {f"{path}/data/rss/{feed.name}_rss.txt",
+                      os.path.abspath(f"data/rss/{feed.name}_rss.txt")}:
+        try:
+            with open(file_name) as rss_file:
+                titles = {line.rstrip("\n") for line in rss_file}
+        except FileNotFoundError:
+            continue
+        store.add(feed.name, [entry_key(entry) for entry in entries
+                              if entry.get("title") in titles])
+        os.replace(file_name, f"{file_name}.imported")
+        logger.info("Imported the seen RSS entries of %s from %s",
+                    feed.name, file_name)
+
+
+class TokenBucket(object):
+    """
+    A token bucket, it gets `rate` tokens per second, and holds up to
+    `capacity` of them. It isn't thread-safe, whoever uses it locks it.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, now: float) -> float:
+        """
+        This method returns how many seconds until a token is available.
+
+        returns: float, 0 if there's one already.
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> bool:
+        """
+        This method takes a token, if there's one.
+
+        returns: True or False
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+PRIORITY_USER: int = 0
+PRIORITY_JOB: int = 1
+
+# the API methods that count towards the per-chat limit, the rest (e.g.
+# kicking) only count towards the global one.
+MESSAGE_METHODS = frozenset({"send_message",
+                             "edit_message_text",
+                             "edit_message_reply_markup"})
+
+# the API methods that have their own budget, `callback_rate`, instead of
+# counting towards the global one, so a busy queue doesn't make the quiz
+# buttons spin until their callback queries time out.
+CALLBACK_METHODS = frozenset({"answer_callback_query"})
+
+
+class Outbound(object):
+    """
+    One API call waiting in the `OutboundQueue`.
+    """
+
+    def __init__(self, method, kwargs: dict, priority: int):
+        self.method = method
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future: Future = Future()
+        self.enqueued: float = time.monotonic()
+        self.not_before: float = 0
+        self.retries: int = 0
+        name = getattr(method, "__name__", "")
+        self.chat_id = kwargs.get("chat_id") \
+            if name in MESSAGE_METHODS else None
+        self.callback: bool = name in CALLBACK_METHODS
+        # the calls of one lane are sent in order, chats take turns.
+        self.lane = "callbacks" if self.callback else self.chat_id
+
+
+class OutboundQueue(object):
+    """
+    Every API call that can get the bot flood-limited goes through here.
+
+    Calls are sent by a pool of `workers` threads, at most `global_rate`
+    per second overall, and at most `chat_rate` messages per second per
+    chat. Callback query answers don't count towards `global_rate`, they
+    have their own `callback_rate` (0 for no limit). Calls with a lower
+    priority number go first (user-facing callbacks before background
+    jobs), and chats take turns, so a chat that's waiting for its limit
+    doesn't hold the others.
+
+    If Telegram answers with RetryAfter, the call is sent again once it's
+    allowed to, up to `max_retries` times.
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, workers: int,
+                 max_retries: int = 5, callback_rate: float = 0):
+        self.chat_rate = chat_rate
+        self.max_retries = max_retries
+        self.workers = workers
+        self.depth: int = 0
+        self.in_flight: int = 0
+        self.sent: int = 0
+        self.retried: int = 0
+        self.failed: int = 0
+        self.dispatched: int = 0
+        self.wait_total: float = 0
+        self.wait_max: float = 0
+        self._global = TokenBucket(global_rate, global_rate)
+        self._callbacks = TokenBucket(callback_rate, callback_rate) \
+            if callback_rate > 0 else None
+        self._chats: dict = {}
+        self._queues: dict = {}
+        self._cond = threading.Condition()
+        self._thread: threading.Thread = None
+        self._pool: ThreadPoolExecutor = None
+
+    def submit(self, method, priority: int = PRIORITY_JOB,
+               **kwargs) -> Future:
+        """
+        This method queues `method(**kwargs)`, e.g.
+        `outbound.submit(bot.sendMessage, chat_id=chat, text="hi")`.
+
+        returns: Future, with the result of the call.
+        """
+        item = Outbound(method, kwargs, priority)
+        with self._cond:
+            if self._thread is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers)
+                self._thread = threading.Thread(
+                    target=self._run, name="outbound", daemon=True)
+                self._thread.start()
+            self._push(item)
+        return item.future
+
+    def _push(self, item: Outbound, first: bool = False) -> None:
+        lanes = self._queues.setdefault(item.priority, OrderedDict())
+        items = lanes.setdefault(item.lane, [])
+        if first:
+            items.insert(0, item)
+        else:
+            items.append(item)
+        self.depth += 1
+        self._cond.notify()
+
+    def _next(self, now: float) -> tuple:
+        if self.depth == 0:
+            return None, None
+        global_wait = self._global.wait(now)
+        callback_wait = 0 if self._callbacks is None else \
+            self._callbacks.wait(now)
+        if global_wait > 0 and callback_wait > 0:
+            return None, min(global_wait, callback_wait)
+        wait = None
+        for priority in sorted(self._queues):
+            lanes = self._queues[priority]
+            for lane in list(lanes):
+                items = lanes[lane]
+                item = items[0]
+                item_wait = max(item.not_before - now, callback_wait
+                                if item.callback else global_wait)
+                if item.chat_id is not None:
+                    bucket = self._chats.get(item.chat_id)
+                    if bucket is None:
+                        bucket = self._chats[item.chat_id] = TokenBucket(
+                            self.chat_rate, 1)
+                    item_wait = max(item_wait, bucket.wait(now))
+                if item_wait > 0:
+                    wait = item_wait if wait is None else min(wait, item_wait)
+                    continue
+                items.pop(0)
+                if items:
+                    lanes.move_to_end(lane)
+                else:
+                    del lanes[lane]
+                if item.chat_id is not None:
+                    self._chats[item.chat_id].take(now)
+                if not item.callback:
+                    self._global.take(now)
+                elif self._callbacks is not None:
+                    self._callbacks.take(now)
+                self.depth -= 1
+                return item, 0
+        return None, wait
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                item, wait = self._next(time.monotonic())
+                while item is None:
+                    self._cond.wait(wait)
+                    item, wait = self._next(time.monotonic())
+                waited = time.monotonic() - item.enqueued
+                self.dispatched += 1
+                self.in_flight += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+            self._pool.submit(self._send, item)
+
+    def _send(self, item: Outbound) -> None:
+        try:
+            self._call(item)
+        finally:
+            with self._cond:
+                self.in_flight -= 1
+                self._cond.notify_all()
+
+    def _call(self, item: Outbound) -> None:
+        try:
+            result = item.method(**item.kwargs)
+        except error.RetryAfter as err:
+            if item.retries < self.max_retries:
+                item.retries += 1
+                item.not_before = time.monotonic() + err.retry_after
+                with self._cond:
+                    self.retried += 1
+                    self._push(item, first=True)
+                return
+            self.failed += 1
+            item.future.set_exception(err)
+        except Exception as err:
+            self.failed += 1
+            logger.warning("%s failed: %r",
+                           getattr(item.method, "__name__", item.method), err)
+            item.future.set_exception(err)
+        else:
+            self.sent += 1
+            item.future.set_result(result)
+
+    def drain(self, timeout: float = None) -> bool:
+        """
+        This method waits until every queued call was sent (or failed).
+
+        returns: True, or False if it timed out.
+        """
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: self.depth == 0 and self.in_flight == 0, timeout)
+
+    def stats(self) -> dict:
+        """
+        This method returns the queue depth and the wait-time metrics.
+
+        returns: dict
+        """
+        return {"depth": self.depth,
+                "sent": self.sent,
+                "retried": self.retried,
+                "failed": self.failed,
+                "wait_avg": self.wait_total / self.dispatched
+                if self.dispatched else 0,
+                "wait_max": self.wait_max}
+
+
+def check_question(question: dict) -> str:
+    """
+    This function checks if a question from `quizzes.json` is usable, i.e.
+    it has a question, some options, and an answer that's one of them.
+
+    returns: str, what's wrong with it, or None if nothing is.
+    """
+    try:
+        if not isinstance(question["question"], str):
+            return "the question isn't a string"
+        if not question["options"] or not all(
+                isinstance(option, str) for option in question["options"]):
+            return "the options aren't a list of strings"
+        if not 0 <= int(question["answer"]) < len(question["options"]):
+            return "the answer isn't one of the options"
+    except (KeyError, TypeError, ValueError) as err:
+        return f"{type(err).__name__}: {err}"
+    return None
+
+
+def render_test_page(start_index: int, end_index: int, page: int,
+                     user_id: int) -> tuple:
+    """
+    This function renders one page of the `/test` preview, i.e. the
+    questions from start_index to end_index, `[GENERAL][test_page_size]`
+    at a time, with the buttons to go to the other pages, which only work
+    for user_id (the admin who sent the `/test`). The range is
+    cut to the questions the bank has now, it comes from the buttons,
+    which can be older than the last reload of the bank.
+
+    returns: tuple, the text and the reply markup.
+    """
+    end_index = min(end_index, len(quiz_bank))
+    start_index = min(start_index, end_index)
+    page_size: int = settings.test_page_size
+    pages: int = max(1, -(-(end_index - start_index) // page_size))
+    page = min(max(page, 0), pages - 1)
+    first: int = start_index + page * page_size
+    text: str = ""
+    for question_id in range(first, min(first + page_size, end_index)):
+        question = quiz_bank[question_id]
+        problem = check_question(question)
+        if problem is not None:
+            text += f"<code>(ID: {question_id})</code> <b>{problem}</b>\n\n"
+            continue
+        text += f'<code>(ID: {question_id})</code>\n{question["question"]}\n'
+        text += "\n".join(question["options"])
+        text += f"\nAnswer: {question['answer']}\n\n"
+    test_range: str = f"{start_index}-{end_index}"
+    keyboard = [[
+        InlineKeyboardButton("<", callback_data=CallbackData(
+            "t", test_range, page - 1, user_id).encode()),
+        InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=CallbackData(
+            "n").encode()),
+        InlineKeyboardButton(">", callback_data=CallbackData(
+            "t", test_range, page + 1, user_id).encode())
+    ]]
+    return text or "Nothing to test.", InlineKeyboardMarkup(keyboard)
+
+
+def format_ban_log(ids_to_ban: dict, results: dict, chats: int,
+                   unknown: list) -> str:
+    """
+    This function builds the `/lban` log message, with the status of every
+    user: OK, FAIL, how many of the chats they were banned from, or "..."
+    if they're still being banned.
+
+    If it's too long for one message, only the users that weren't banned
+    from every chat are listed.
+
+    returns: str
+    """
+    done: int = sum(len(kicks) for kicks in results.values())
+    header: str = f"<b>Banning log:</b> {done}/{len(ids_to_ban) * chats}"
+    lines: list = []
+    banned: int = 0
+    for usr, label in ids_to_ban.items():
+        kicks = results[usr]
+        if len(kicks) < chats:
+            status = "..."
+        elif all(kicks):
+            status = "OK"
+            banned += 1
+        elif any(kicks):
+            status = f"{sum(kicks)}/{chats}"
+        else:
+            status = "FAIL"
+        lines.append((status, f"<code>{html.escape(str(label))} {'.'*5} "
+                              f"{status}</code>"))
+    lines += [("UNKNOWN", f"<code>{html.escape(mention)} {'.'*5} "
+                          f"UNKNOWN</code>") for mention in unknown]
+    text = "\n".join([header] + [line for _, line in lines])
+    if len(text) > 4096:
+        text = "\n".join([header] +
+                         [line for status, line in lines if status != "OK"] +
+                         [f"(+{banned} OK)"])
+    return text[:4096]
+
+
+def load_quiz_stats() -> dict:
+    """
+    This function reads the quiz analytics the quiz scripts keep (see
+    STATS_KEYS) in one round trip, so it costs the same however many
+    users took the quiz.
+
+    The answers are counted by question key, they're matched with the
+    questions of the current bank, the ones that aren't in it anymore
+    (and the counters from before the keys) are left out.
+
+    returns: dict, with "questions" ({question ID: [correct, wrong]}),
+    "results" (the counters of stats:results), "takers", "finishers" and
+    "allowed" (everyone who's in users:allowed).
+    """
+    pipe = rdb.pipeline(transaction=False)
+    pipe.hgetall("stats:questions")
+    pipe.hgetall("stats:results")
+    pipe.pfcount("stats:takers")
+    pipe.pfcount("stats:finishers")
+    pipe.scard("users:allowed")
+    answers, results, takers, finishers, allowed = pipe.execute()
+    questions: dict = {}
+    for field, count in answers.items():
+        key, _, choice = field.decode("utf-8").partition(":")
+        question_id = quiz_bank.find_key(key) if len(key) == 16 else None
+        if question_id is None:
+            continue
+        questions.setdefault(question_id, [0, 0])[choice != "c"] += \
+            int(count)
+    return {"questions": questions,
+            "results": {field.decode("utf-8"): int(count)
+                        for field, count in results.items()},
+            "takers": takers,
+            "finishers": finishers,
+            "allowed": allowed}
+
+
+def format_quiz_stats(stats: dict, hardest: int = 10,
+                      min_answers: int = 5) -> str:
+    """
+    This function builds the `/stats` message: how many users took and
+    finished the quiz, the pass rate, how long the quizzes took (the
+    median is the first of STATS_BUCKETS that half of them fit in), and
+    the `hardest` questions with the most wrong answers, out of the ones
+    answered at least `min_answers` times.
+
+    returns: str
+    """
+    results: dict = stats["results"]
+    passed, failed = results.get("passed", 0), results.get("failed", 0)
+    finished = passed + failed
+    lines: list = [
+        "<b>Quiz stats:</b>",
+        f"Took the quiz: ~{stats['takers']}, finished it: "
+        f"~{stats['finishers']}, allowed: {stats['allowed']}",
+        f"Passed: {passed}, failed: {failed}"
+        + (f" ({passed / finished:.0%} passed)" if finished else "")]
+    for status, label in (("passed", "pass"), ("failed", "fail")):
+        timed: int = sum(results.get(f"{status}:{le}", 0)
+                         for le in STATS_BUCKETS + ("inf",))
+        if not timed:
+            continue
+        seen: int = 0
+        median: str = f"> {STATS_BUCKETS[-1]}s"
+        for le in STATS_BUCKETS:
+            seen += results.get(f"{status}:{le}", 0)
+            if seen * 2 >= timed:
+                median = f"≤ {le}s"
+                break
+        lines.append(f"Time to {label}: median {median}, average "
+                     f"{results.get(f'{status}:seconds', 0) / timed:.0f}s")
+    ranked = sorted(((wrong / (correct + wrong), question_id, correct, wrong)
+                     for question_id, (correct, wrong)
+                     in stats["questions"].items()
+                     if correct + wrong >= min_answers), reverse=True)
+    if ranked:
+        lines.append("\n<b>Most failed questions:</b>")
+    lines += [f"<code>(ID: {question_id})</code> {wrong}/{correct + wrong} "
+              f"wrong ({rate:.0%})"
+              for rate, question_id, correct, wrong in ranked[:hardest]]
+    return "\n".join(lines)
+
+
+def mention(user) -> str:
+    """
+    This function makes a Markdown mention of the given user, the
+    characters Markdown would choke on are removed from their name.
+
+    returns: str
+    """
+    name = re.sub(r"[\[\]()*_`]", "", user.first_name or "") or str(user.id)
+    return f"[{name}](tg://user?id={user.id})"
+
+
+class JoinGreeter(object):
+    """
+    This class sends one greeting for everyone who joined a chat during
+    `window` seconds, instead of one reply per member.
+
+    The first join in a chat schedules the greeting with the job queue,
+    the members who join before it's sent are added to it. At most
+    `max_mentions` members are mentioned in it.
+    """
+
+    def __init__(self, window: int, max_mentions: int = 10):
+        self.window = window
+        self.max_mentions = max_mentions
+        self.sent = 0
+        self.greeted = 0
+        self._pending: dict = {}
+        self._lock = threading.Lock()
+
+    def add(self, bot: Bot, job_queue, chat_id: int, message_id: int,
+            members: list) -> None:
+        with self._lock:
+            pending = self._pending.get(chat_id)
+            if pending is not None:
+                pending[1].extend(members)
+                return
+            self._pending[chat_id] = (message_id, list(members))
+        if self.window <= 0:
+            self.flush(bot, chat_id)
+        else:
+            job_queue.run_once(
+                instrument("job", "greet_flush",
+                           lambda bot, job: self.flush(bot, job.context)),
+                self.window, context=chat_id)
+
+    def flush(self, bot: Bot, chat_id: int) -> None:
+        with self._lock:
+            message_id, members = self._pending.pop(chat_id)
+            self.sent += 1
+            self.greeted += len(members)
+        mentions = ", ".join(
+            mention(member) for member in members[:self.max_mentions])
+        if len(members) > self.max_mentions:
+            mentions += f" (+{len(members) - self.max_mentions})"
+        outbound.submit(
+            bot.sendMessage, priority=PRIORITY_USER,
+            chat_id=chat_id,
+            text=f"{mentions}\n{settings.send_me_start}",
+            reply_to_message_id=message_id,
+            parse_mode="Markdown",
+            disable_web_page_preview=True)
+
+
+class TestRun(object):
+    """
+    The state of a `/test` that checks its questions in the background.
+    """
+
+    def __init__(self, chat_id: int, message_id: int, question_ids: range):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.question_ids = question_ids
+        self.position: int = 0
+        self.problems: list = []
+
+
+class LRUCache(object):
+    """
+    A thread-safe dict that only keeps the `maxsize` most recently
+    used keys.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+# the nonce of the newest session every user was seen with, so clicks on
+# buttons from older sessions are rejected without asking Redis.
+session_nonces = LRUCache(100000)
+
+# the username every user was last saved with by this process, and when,
+# so the users who keep chatting aren't saved on every message.
+known_usernames = LRUCache(100000)
+
+# The username index, username:{lowercase username} → user ID, next to the
+# username in user:{id}, both expire after `[USER][user_ttl]`.
+# KEYS = user:{id} and username:{lowercase username} of every user,
+# ARGV[1] = user_ttl, then the user ID and username of every user.
+# A user's old username is dropped if it still points to them.
+LUA_REMEMBER_USERS = """
+for i = 1, #KEYS, 2 do
+    local user_id, username = ARGV[i + 1], ARGV[i + 2]
+    local old = redis.call("HGET", KEYS[i], "username")
+    if old and old ~= username then
+        local old_key = "username:" .. string.lower(old)
+        if old_key ~= KEYS[i + 1] and
+                redis.call("GET", old_key) == user_id then
+            redis.call("DEL", old_key)
+        end
+    end
+    redis.call("HSET", KEYS[i], "username", username)
+    redis.call("EXPIRE", KEYS[i], ARGV[1])
+    redis.call("SET", KEYS[i + 1], user_id, "EX", ARGV[1])
+end
+return #KEYS / 2
+"""
+
+
+def remember_users(users: list, client=None) -> int:
+    """
+    This function saves the usernames of the given users in the username
+    index, all of them in one script call, which is queued in `client` if
+    it's a pipeline.
+
+    Users without a username are skipped, and so are the users this
+    process saved with the same username in the last `user_ttl / 2`
+    seconds (see `known_usernames`).
+
+    returns: int, how many users were saved.
+    """
+    now = time.monotonic()
+    keys: list = []
+    args: list = [settings.user_ttl]
+    for user in users:
+        if user is None or not user.username:
+            continue
+        known = known_usernames.get(user.id)
+        if known is not None and known[0] == user.username and \
+                now - known[1] < settings.user_ttl / 2:
+            continue
+        known_usernames.set(user.id, (user.username, now))
+        keys += [f"user:{user.id}", f"username:{user.username.lower()}"]
+        args += [user.id, user.username]
+    if keys:
+        remember_users_script(keys=keys, args=args,
+                              client=rdb if client is None else client)
+    return len(keys) // 2
+
+
+def find_users(usernames: list) -> list:
+    """
+    This function looks up the user IDs of the given usernames (with or
+    without the @) in the username index, with one MGET.
+
+    returns: list of user IDs, None for the usernames that aren't in it.
+    """
+    if not usernames:
+        return []
+    user_ids = rdb.mget([f"username:{username.lstrip('@').lower()}"
+                         for username in usernames])
+    return [None if user_id is None else int(user_id)
+            for user_id in user_ids]
+
+
+# the locks that make the button clicks of the same user run one at a time,
+# users share them, so there's a fixed number of them.
+USER_LOCKS: tuple = tuple(threading.Lock() for _ in range(64))
+
+
+def user_lock(user_id: int) -> threading.Lock:
+    """
+    This function returns the lock of the given user.
+
+    returns: threading.Lock
+    """
+    return USER_LOCKS[user_id % len(USER_LOCKS)]
+
+
+# KEYS[1] = clicks:{id}, ARGV = [rate, burst, now]. The token bucket of a
+# user in Redis, shared by every process. Returns 1 if the click can go.
+LUA_CLICK_LIMIT = """
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens))
+redis.call("HSET", KEYS[1], "updated", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 1)
+return allowed
+"""
+
+
+class ClickLimiter(object):
+    """
+    A token bucket per user for the quiz buttons, every user gets `rate`
+    clicks per second, and up to `burst` of them at once. The buckets are
+    kept in memory (for the last `maxsize` users), so a user hammering
+    the buttons is stopped before anything touches Redis.
+
+    With a `client`, the clicks the local bucket lets through are also
+    checked against a bucket in Redis (see LUA_CLICK_LIMIT), for when
+    several processes handle the clicks of the same user.
+    """
+
+    def __init__(self, rate: float, burst: int, client=None,
+                 maxsize: int = 100000):
+        self.rate = rate
+        self.burst = burst
+        self.allowed: int = 0
+        self.throttled: int = 0
+        self.throttled_shared: int = 0
+        self._buckets = LRUCache(maxsize)
+        self._script = None if client is None else \
+            client.register_script(LUA_CLICK_LIMIT)
+        self._lock = threading.Lock()
+
+    def allow(self, user_id: int) -> bool:
+        """
+        This method takes a token from the user's bucket, if there's one.
 
-rdb: redis.Redis = redis.Redis(
-    host=config["REDIS"]["host"],
-    port=int(config["REDIS"]["port"]),
-    db=0)
+        returns: True or False
+        """
+        with self._lock:
+            bucket = self._buckets.get(user_id)
+            if bucket is None or bucket.capacity != self.burst or \
+                    bucket.rate != self.rate:
+                bucket = TokenBucket(self.rate, self.burst)
+                self._buckets.set(user_id, bucket)
+            if not bucket.take(time.monotonic()):
+                self.throttled += 1
+                return False
+        if self._script is not None and not self._script(
+                keys=[f"clicks:{user_id}"],
+                args=[self.rate, self.burst, time.time()]):
+            with self._lock:
+                self.throttled += 1
+                self.throttled_shared += 1
+            return False
+        with self._lock:
+            self.allowed += 1
+        return True
 
-with open(f"{path}/data/quizzes.json") as quizzes_json:
-    quizzes = json.load(quizzes_json)
+    def stats(self) -> dict:
+        """
+        This method returns the counters of the limiter.
 
+        returns: dict
+        """
+        return {"allowed": self.allowed,
+                "throttled": self.throttled,
+                "throttled_shared": self.throttled_shared,
+                "users": len(self._buckets)}
+
+
+# KEYS[1] = the lease, ARGV[1] = the name of this process, ARGV[2] = the
+# lease's TTL in milliseconds. Returns 1 if this process holds the lease.
+LUA_LEASE = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    redis.call("PEXPIRE", KEYS[1], ARGV[2])
+    return 1
+end
+if redis.call("SET", KEYS[1], ARGV[1], "NX", "PX", ARGV[2]) then
+    return 1
+end
+return 0
+"""
+
+LUA_RELEASE = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+class LeaderLease(object):
+    """
+    This class elects one leader among the processes of the bot that
+    share the same Redis, so the jobs only run once.
+
+    The leader is whoever holds the `name` key, it's renewed every
+    `renew` seconds by a thread, and it expires after `ttl` seconds if
+    the leader dies, then another process takes it. A process stops
+    thinking it's the leader `ttl` seconds after its last successful
+    renewal started, which is never later than the key expires.
+    """
 
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO)
+    def __init__(self, client: redis.Redis, name: str, ttl: int,
+                 instance: str):
+        self.name = name
+        self.ttl = ttl
+        self.instance = instance
+        self.changes = 0
+        self._refresh = client.register_script(LUA_LEASE)
+        self._release = client.register_script(LUA_RELEASE)
+        self._valid_until = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def is_leader(self) -> bool:
+        return time.monotonic() < self._valid_until
+
+    def refresh(self) -> bool:
+        """
+        This method takes or renews the lease. If Redis can't be reached,
+        the process stays the leader until its lease would've expired.
 
-logger = logging.getLogger(__name__)
+        returns: True if this process is the leader.
+        """
+        started = time.monotonic()
+        was_leader = self.is_leader
+        try:
+            if self._refresh(keys=[self.name],
+                             args=[self.instance, int(self.ttl * 1000)]):
+                self._valid_until = started + self.ttl
+            else:
+                self._valid_until = 0.0
+        except redis.RedisError as e:
+            logger.warning("Couldn't renew the lease %s: %s", self.name, e)
+        if self.is_leader != was_leader:
+            self.changes += 1
+            if was_leader:
+                logger.warning("%s isn't the leader anymore", self.instance)
+            else:
+                logger.info("%s is the leader now", self.instance)
+        return self.is_leader
 
+    def start(self, renew: int) -> None:
+        self.refresh()
+        self._thread = threading.Thread(
+            target=self._run, args=(renew,), daemon=True,
+            name="leader-lease")
+        self._thread.start()
 
-def is_admin(bot: Bot, update: Update, user_id: int) -> bool:
-    """
-    This function checks if the given user_id is an admin
+    def _run(self, renew: int) -> None:
+        while not self._stop.wait(renew):
+            self.refresh()
 
-    returns True or False.
-    """
-    admins: list = [admin.user.id for admin in
-                    bot.get_chat_administrators(update.message.chat.id)]
-    return user_id in admins
+    def stop(self) -> None:
+        """
+        This method stops renewing the lease and gives it up, so another
+        process can take it right away.
 
+        returns: None
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._valid_until = 0.0
+        try:
+            self._release(keys=[self.name], args=[self.instance])
+        except redis.RedisError:
+            pass
 
-def is_digit(obj: object) -> bool:
-    """
-    This functions checks if the given object is a digit.
 
-    returns: True or False
+def leader_only(callback, lease: LeaderLease):
     """
-    try:
-        int(float(obj))
-        return True
-    except ValueError:
-        return False
+    This function wraps a job, so it only runs in the process that holds
+    the lease. Without a lease (a single process), it always runs.
 
+    returns: function
+    """
+    def run(bot: Bot, job) -> None:
+        if lease is None or lease.is_leader:
+            callback(bot, job)
+    return run
+
+
+# name: (type, help) of every metric, in the order they're exported.
+METRICS: dict = {
+    "gatebot_handler_seconds": (
+        "histogram", "How long the update handlers took."),
+    "gatebot_handler_errors_total": (
+        "counter", "Update handlers that raised an exception."),
+    "gatebot_job_seconds": (
+        "histogram", "How long the jobs took."),
+    "gatebot_job_lag_seconds": (
+        "histogram", "How late the repeating jobs started."),
+    "gatebot_job_errors_total": (
+        "counter", "Jobs that raised an exception."),
+    "gatebot_redis_seconds": (
+        "histogram", "Redis round trips by command, PIPELINE for pipelines."),
+    "gatebot_redis_pipelined_commands_total": (
+        "counter", "Redis commands sent in pipelines."),
+    "gatebot_redis_errors_total": (
+        "counter", "Redis round trips that failed."),
+    "gatebot_telegram_seconds": (
+        "histogram", "Telegram API calls by method."),
+    "gatebot_telegram_errors_total": (
+        "counter", "Telegram API calls that failed."),
+    "gatebot_admin_cache": (
+        "gauge", "The counters of the administrators cache."),
+    "gatebot_outbound": (
+        "gauge", "The depth and counters of the outbound queue."),
+    "gatebot_buttons": (
+        "gauge", "API calls the quiz buttons didn't make, in total and per "
+                 "quiz finished."),
+    "gatebot_clicks": (
+        "gauge", "Quiz button clicks let through and throttled by the "
+                 "per-user limit."),
+    "gatebot_keys": (
+        "gauge", "Redis keys by prefix, as of the last full compaction pass."),
+    "gatebot_keys_without_ttl": (
+        "gauge", "Redis keys without a TTL by prefix, as of the last full "
+                 "compaction pass."),
+    "gatebot_compacted_keys": (
+        "gauge", "Keys from older versions that the compaction job gave a "
+                 "TTL or dropped."),
+}
+
+
+class Metrics(object):
+    """
+    This class keeps the counters and histograms of the bot, and
+    exports them in the Prometheus text format.
 
-def parse_rss(string: str) -> dict:
+    When it's disabled, nothing gets wrapped (see `instrument()`), so it
+    costs nothing. `collectors` are functions returning a list of
+    (name, labels, value) for the gauges, called on every scrape.
     """
-    This function parses the RSS syntax string into a Python dictionary.
 
-    If `interval` is not provided, then it defaults to the [GENERAL] section.
-    rss_interval, which has the default value of 1200.
+    BUCKETS: tuple = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                      1, 2.5, 5, 10, 30)
+    LABEL_ESCAPES: dict = str.maketrans({"\\": "\\\\", '"': '\\"',
+                                         "\n": "\\n"})
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.collectors: list = []
+        self._values: dict = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._values.get(key)
+            if histogram is None:
+                histogram = self._values[key] = [0] * (len(self.BUCKETS) + 2)
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += value
+
+    @staticmethod
+    def _labels(labels: tuple, **extra) -> str:
+        pairs = [f'{name}="{str(value).translate(Metrics.LABEL_ESCAPES)}"'
+                 for name, value in labels + tuple(extra.items())]
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> str:
+        """
+        This method renders every metric in the Prometheus text format.
 
-    If `first` is not provided, then it defaults to the [GENERAL] section.
-    rss_first, which has the default value of 5.
+        returns: str
+        """
+        with self._lock:
+            values = {key: value if isinstance(value, (int, float))
+                      else list(value)
+                      for key, value in self._values.items()}
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                values[(name, tuple(sorted(labels.items())))] = value
+        lines: list = []
+        for name, (kind, description) in METRICS.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (key, labels), value in sorted(values.items()):
+                if key != name:
+                    continue
+                if kind != "histogram":
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+                    continue
+                for bound, count in zip(self.BUCKETS + ("+Inf",), value):
+                    lines.append(f"{name}_bucket"
+                                 f"{self._labels(labels, le=bound)} {count}")
+                lines.append(f"{name}_count{self._labels(labels)} "
+                             f"{value[-2]}")
+                lines.append(f"{name}_sum{self._labels(labels)} "
+                             f"{value[-1]}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, listen: str, port: int) -> ThreadingHTTPServer:
+        """
+        This method serves the metrics on http://{listen}:{port}/metrics
+        in a thread.
 
-    returns: dict
-    """
-    parsed: dict = {}
-    for kv in string.split(","):
-        kv = kv.split("=")
-        key: str = kv[0]
-        value: str = kv[1]
-        if key == "link" and "reddit" in value:
-            value = f"https://www.reddit.com/r/{value.split(':')[1]}/.rss"
-        elif key == "interval" or key == "first":
-            value = int(value)
-        parsed[key] = value
-    if "interval" not in parsed:
-        parsed["interval"] = int(config["GENERAL"]["rss_interval"])
-    if "first" not in parsed:
-        parsed["first"] = int(config["GENERAL"]["rss_first"])
-    return parsed
+        returns: ThreadingHTTPServer
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
 
+        server = ThreadingHTTPServer((listen, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True,
+                         name="metrics").start()
+        return server
 
-def parse_list(string: str, splitter: str = ",") -> list:
+
+def instrument(kind: str, name: str, callback):
     """
-    This function will parse the given string into a list,
-    separating values with a comma, however:
+    This function wraps a handler (kind "handler") or a job (kind "job")
+    so its latency and errors are recorded, jobs also record how late
+    they started, compared to their interval. Handlers that are run with
+    @run_async are timed in the worker, not when they're handed to it.
 
-    You can change that if you want with the splitter parameter.
+    If the metrics are disabled, the callback is returned as is.
 
-    it will use `is_digit()` to check if the current string is a digit,
+    returns: function
+    """
+    if not metrics.enabled:
+        return callback
+    inner = getattr(callback, "__wrapped__", None)
+    if inner is not None:
+        return run_async(instrument(kind, name,
+                                    inner.__get__(callback.__self__)))
+    last_start: list = [None]
+
+    def run(bot: Bot, *args, **kwargs):
+        started = time.perf_counter()
+        if kind == "job" and last_start[0] is not None and \
+                getattr(args[0], "interval", None):
+            metrics.observe(
+                "gatebot_job_lag_seconds",
+                max(0.0, started - last_start[0] - args[0].interval),
+                job=name)
+        last_start[0] = started
+        try:
+            return callback(bot, *args, **kwargs)
+        except Exception:
+            metrics.inc(f"gatebot_{kind}_errors_total", **{kind: name})
+            raise
+        finally:
+            metrics.observe(f"gatebot_{kind}_seconds",
+                            time.perf_counter() - started, **{kind: name})
+    return run
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    """A pipeline that records its round trips in `metrics`."""
+
+    def execute(self, raise_on_error: bool = True) -> list:
+        commands = len(self)
+        started = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        except redis.RedisError:
+            metrics.inc("gatebot_redis_errors_total", command="PIPELINE")
+            raise
+        finally:
+            metrics.observe("gatebot_redis_seconds",
+                            time.perf_counter() - started, command="PIPELINE")
+            metrics.inc("gatebot_redis_pipelined_commands_total", commands)
+
+
+class InstrumentedRedis(redis.Redis):
+    """A Redis client that records every command in `metrics`."""
+
+    def execute_command(self, *args, **options):
+        command = str(args[0]).upper()
+        started = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        except redis.RedisError:
+            metrics.inc("gatebot_redis_errors_total", command=command)
+            raise
+        finally:
+            metrics.observe("gatebot_redis_seconds",
+                            time.perf_counter() - started, command=command)
+
+    def pipeline(self, transaction: bool = True,
+                 shard_hint=None) -> InstrumentedPipeline:
+        return InstrumentedPipeline(self.connection_pool,
+                                    self.response_callbacks,
+                                    transaction, shard_hint)
+
+
+class InstrumentedRequest(Request):
+    """The connection of the bot, it records every API call in `metrics`."""
+
+    def _timed(self, call, url: str, *args, **kwargs):
+        method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            return call(url, *args, **kwargs)
+        except error.TelegramError as e:
+            metrics.inc("gatebot_telegram_errors_total", method=method,
+                        error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("gatebot_telegram_seconds",
+                            time.perf_counter() - started, method=method)
+
+    def get(self, url: str, timeout: float = None):
+        return self._timed(super().get, url, timeout=timeout)
+
+    def post(self, url: str, data: dict, timeout: float = None):
+        return self._timed(super().post, url, data, timeout=timeout)
+
+
+# The state of the bot, it's all built by `setup()`, so importing this
+# module doesn't read any file or connect to anything.
+settings: Settings = None
+metrics: Metrics = None
+rdb: redis.Redis = None
+
+quizzes_file: str = f"{path}/data/quizzes.json"
+quiz_bank: QuizBank = None
+quiz_bank_stat: tuple = None
+quiz_bank_lock = threading.Lock()
+# the banks of the last few generations, for the sessions made before the
+# quiz bank was reloaded.
+quiz_banks = LRUCache(4)
+
+
+def reload_quiz_bank(force: bool = False) -> bool:
+    """
+    This function reloads `quizzes.json` if it changed since it was last
+    loaded. The new bank is fully loaded before it replaces the old one,
+    and the sessions that were made with the old one keep using it.
 
-    if it is, then it will add it as a digit. That's it.
+    If the new file is broken, the old bank is kept.
 
-    returns: list
+    returns: True if a new bank was loaded.
     """
-    return [int(i.strip()) if is_digit(i)
-            else i.strip() for i in string.split(splitter)]
+    global quiz_bank, quiz_bank_stat
+    with quiz_bank_lock:
+        try:
+            stat = os.stat(quizzes_file)
+        except OSError as err:
+            logger.error("Couldn't check %s: %r", quizzes_file, err)
+            return False
+        if not force and (stat.st_mtime_ns, stat.st_size) == quiz_bank_stat:
+            return False
+        quiz_bank_stat = (stat.st_mtime_ns, stat.st_size)
+        try:
+            new_bank = QuizBank.load(quizzes_file)
+        except (OSError, KeyError, TypeError, ValueError) as err:
+            logger.error("Couldn't reload %s, keeping the old questions: %r",
+                         quizzes_file, err)
+            return False
+        if new_bank.generation == quiz_bank.generation:
+            return False
+        quiz_banks.set(new_bank.generation, new_bank)
+        quiz_bank = new_bank
+        logger.info("Loaded %d questions from %s (generation %s)",
+                    len(new_bank), quizzes_file, new_bank.generation)
+        return True
 
 
-def parse_dict(section: str) -> dict:
+def session_bank(nonce: str) -> QuizBank:
     """
-    This function simply returns a dictionary based off a section of choice.
+    This function returns the quiz bank a session's questions are from,
+    by the generation in its nonce. Sessions without one use the current
+    bank. If the generation isn't known, the file might've changed (e.g.
+    in another process of the bot), so it's checked again.
 
-    returns: dict
+    returns: QuizBank, or None if it's too old to be kept.
     """
-    return {key: value for key, value in config[section].items()}
+    generation = nonce.partition(".")[2]
+    if not generation:
+        return quiz_bank
+    bank = quiz_banks.get(generation)
+    if bank is None and reload_quiz_bank():
+        bank = quiz_banks.get(generation)
+    return bank
 
 
-def decode_dict(obj: dict) -> dict:
-    """
-    This function simply parses a dict from the Redis database
-    and decode every value.
+ready_script: redis.client.Script = None
+navigate_script: redis.client.Script = None
+answer_script: redis.client.Script = None
+remember_users_script: redis.client.Script = None
 
-    returns: dict
+
+def reload_settings(signum: int = None, frame: object = None) -> None:
     """
-    return {key.decode("utf-8"): val.decode("utf-8")
-            for key, val in obj.items()}
+    This function reloads `config.ini` and swaps the new settings in,
+    it's the SIGHUP handler, so `kill -HUP` reloads the bot's config
+    without restarting it.
 
+    If the new config is broken, the old settings are kept.
 
-def get_results(obj: dict) -> dict:
+    Things that are only read at startup (the bot token, the workers,
+    Redis, the commands, the outbound queue's rates and workers,
+    click_shared, the RSS feeds and their options, webhook, cluster,
+    metrics, the jobs' intervals and compact_batch) still need a restart,
+    see README.md.
+
+    returns: None
     """
-    This function will give you the results from a dictionary.
-    For an example {"unanswered": 9, "correct": 2, "wrong": 2}
-    And it just does that, the button handler will do the rest.
-    E.g. see if the "correct" value is the same or bigger than the
-    one in the config file.
+    global settings
+    try:
+        new_settings = load_settings(config_file)
+    except (OSError, KeyError, TypeError, ValueError,
+            configparser.Error) as err:
+        logger.error("Couldn't reload %s, keeping the old settings: %r",
+                     config_file, err)
+        return
+    settings = new_settings
+    admin_cache.ttl = new_settings.admin_cache_ttl
+    join_greeter.window = new_settings.join_window
+    click_limiter.rate = new_settings.click_rate
+    click_limiter.burst = new_settings.click_burst
+    reload_quiz_bank()
+    logger.info("Reloaded %s", config_file)
+
+
+admin_cache: AdminCache = None
+outbound: OutboundQueue = None
+join_greeter: JoinGreeter = None
+click_limiter: ClickLimiter = None
+
+
+def setup(config: str = None, quizzes: str = None) -> Settings:
+    """
+    This function builds the state of the bot: its settings, metrics,
+    Redis client and scripts, quiz bank and outbound queue. The Redis
+    client only connects when it's first used.
 
-    returns: dict
+    It's only done once, the next calls just return the settings, so
+    anything that needs the bot's state (`main()`, the benchmarks) can
+    call it first.
+
+    raises: FileNotFoundError if the config file can't be read, see
+    `load_settings()` for the other errors.
+
+    returns: Settings
     """
-    parsed = {"u": 0, "c": 0, "w": 0}
-    for value in obj.values():
-        parsed[value] += 1
-    return parsed
+    global settings, metrics, rdb, config_file, quizzes_file
+    global quiz_bank, quiz_bank_stat
+    global ready_script, navigate_script, answer_script
+    global remember_users_script, admin_cache, outbound, join_greeter
+    global click_limiter
+    if settings is not None:
+        return settings
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO)
+    config_file = config or config_file
+    quizzes_file = quizzes or quizzes_file
+    new_settings = load_settings(config_file)
+
+    metrics = Metrics(new_settings.metrics)
+    rdb = (InstrumentedRedis if metrics.enabled else redis.Redis)(
+        host=new_settings.redis_host,
+        port=new_settings.redis_port,
+        db=0)
+    ready_script = rdb.register_script(LUA_READY)
+    navigate_script = rdb.register_script(LUA_NAVIGATE)
+    answer_script = rdb.register_script(LUA_ANSWER)
+    remember_users_script = rdb.register_script(LUA_REMEMBER_USERS)
+
+    stat = os.stat(quizzes_file)
+    quiz_bank = QuizBank.load(quizzes_file)
+    quiz_bank_stat = (stat.st_mtime_ns, stat.st_size)
+    quiz_banks.set(quiz_bank.generation, quiz_bank)
+
+    admin_cache = AdminCache(new_settings.admin_cache_ttl)
+    outbound = OutboundQueue(new_settings.global_rate,
+                             new_settings.chat_rate,
+                             new_settings.send_workers,
+                             callback_rate=new_settings.callback_rate)
+    join_greeter = JoinGreeter(new_settings.join_window)
+    click_limiter = ClickLimiter(
+        new_settings.click_rate, new_settings.click_burst,
+        rdb if new_settings.click_shared else None)
+    settings = new_settings
+    return settings
 
 
 class GateHandlers(object):
 
-    def new_status(self, bot: Bot, update: Update) -> None:
+    def remember_sender(self, bot: Bot, update: Update) -> None:
+        """
+        This function saves the username of whoever sent a group message,
+        and of whoever they replied to, so `/lban @username` knows them
+        (see `remember_users()`). Most messages don't touch Redis, only the
+        users whose username changed, or who weren't saved for a while.
+
+        returns: None
+        """
+        message = update.effective_message
+        if message is None:
+            return
+        remember_users([message.from_user,
+                        message.reply_to_message.from_user
+                        if message.reply_to_message else None])
+
+    def new_status(self, bot: Bot, update: Update, job_queue) -> None:
         """
         This function handles incoming users or users leaving.
 
-        If the user is a new chat member, then it will restrict them and
-        link them to the bot, sending a message saying so (configurable).
+        If there are new chat members, then it will restrict all of them
+        and link them to the bot, sending a message saying so
+        (configurable). Their usernames (see `remember_users()`) and
+        deadlines are saved in one pipeline, the restrictions go through
+        the outbound queue, and everyone who joined within `join_window`
+        seconds gets one greeting (see JoinGreeter), so a join raid
+        doesn't flood the chat.
 
         If the user is a member leaving (e.g. getting banned by the bot), then:
         It will check and see if config.ini wants to delete the status message.
         If it does, then delete it, otherwise, do nothing.
 
+        Status updates that can change the administrators of the chat (an
+        admin leaving, or the bot itself being added) drop the cached
+        administrators list of that chat.
+
         returns: None
         """
-        main_chats = config["CHATS"]["main_chats"]
-        if update.message.chat_id not in parse_list(main_chats):
+        chat_id = update.message.chat.id
+        left_member = update.message.left_chat_member
+        new_members = update.message.new_chat_members
+        if left_member is not None and \
+                admin_cache.is_cached_admin(chat_id, left_member.id):
+            admin_cache.invalidate(chat_id)
+        if any(member.id == bot.id for member in new_members):
+            admin_cache.invalidate(chat_id)
+        if update.message.chat_id not in settings.main_chats:
             update.message.reply_text(
-                config["STRINGS"]["unknown_group"],
-                format(ID=update.message.chat.id))
-        else:
-            if update.message.new_chat_members:
-                from_id = update.message.new_chat_members[0].id
-                from_username = update.message.new_chat_members[0].username
-                if from_id in parse_list(config["CHATS"]["main_chats"]):
-                    update.message.reply_text(
-                        config["STRINGS"]["new_member_bot"])
-                elif is_admin(bot, update, from_id):
-                    pass
-                else:
-                    if from_username is not None:
-                        rdb.hset(f"user:{from_id}", "username", from_username)
-                    rdb.hset("users:start", from_id, time.time())
-                    bot.restrict_chat_member(
-                        chat_id=update.message.chat.id,
-                        user_id=from_id,
-                        can_send_message=False,
-                        can_send_media_messages=False,
-                        can_send_other_messages=False,
-                        can_add_web_page_previews=False)
-                    ans = int(config['GENERAL']['correct_answers'])
-                    que = int(config['GENERAL']['questions_count'])
-                    update.message.reply_text(
-                        text=config["STRINGS"]["send_me_start"].format(
-                            correct_answers=ans,
-                            questions_count=que,
-                            calc_percentage=f"{int((ans/que)*100)}"),
-                        parse_mode="Markdown",
-                        disable_web_page_preview=True)
+                settings.strings["unknown_chat"].format(
+                    ID=update.message.chat.id),
+                parse_mode="Markdown")
+        elif new_members:
+            if any(member.id == bot.id for member in new_members):
+                update.message.reply_text(
+                    settings.strings["new_member_bot"])
+            admins = admin_cache.get(bot, chat_id)
+            members = [member for member in new_members
+                       if member.id != bot.id and member.id not in admins]
+            if not members:
+                return
+            deadline = time.time() + settings.check_sent_start
+            pipe = rdb.pipeline(transaction=False)
+            remember_users(members, pipe)
+            pipe.zadd("users:start:deadlines",
+                      {member.id: deadline for member in members})
+            pipe.execute()
+            for member in members:
+                outbound.submit(
+                    bot.restrictChatMember, priority=PRIORITY_USER,
+                    chat_id=chat_id,
+                    user_id=member.id,
+                    can_send_messages=False,
+                    can_send_media_messages=False,
+                    can_send_other_messages=False,
+                    can_add_web_page_previews=False)
+            join_greeter.add(bot, job_queue, chat_id,
+                             update.message.message_id, members)
 
 
 class GateButtons(object):
+    """Main class for the buttons. Every method gets the callback query
+    it's handling, and the quiz state is only changed by the scripts in
+    Redis, so the buttons can be handled by many workers at once. The
+    only state kept here are the counters of the API calls it didn't
+    make (see `stats()`)."""
+
     def __init__(self):
-        self.query = None
+        self.actions: dict = {
+            "r": self.ready_handler,
+            "f": self.forward_or_back_handler,
+            "b": self.forward_or_back_handler,
+            "a": self.check_answer,
+            "t": self.test_page_handler,
+            "n": None}
+        self.answers_saved: int = 0
+        self.edits_skipped: int = 0
+        self.quizzes: int = 0
+        self._lock = threading.Lock()
 
     """
     This method checks and sees what button handlers to call.
     It changes the direction of the call.
 
+    The button's data is decoded once, see `CallbackData`, and the handler
+    is looked up in `self.actions`. Buttons of this user's older sessions
+    (see `session_nonces`) are rejected before anything else, and users
+    clicking faster than `click_rate` (see `ClickLimiter`) only get
+    `[STRINGS]["too_many_clicks"]`, even before that.
+
+    The handlers return the alert to show, if any, and the click is
+    answered here, exactly once, with it.
+
+    It runs in a worker thread, the clicks of the same user are handled
+    one at a time (see `user_lock()`), so their messages are edited in
+    the order they clicked.
+
     returns: None
     """
+    @run_async
     def diverter(self, bot: Bot, update: Update) -> None:
-        self.query = update.callback_query
-        print(self.query.data)
-        if (self.query.data == "ready" or self.query.data[0] == "ready"):
-            self.ready_handler(bot, update)
-        elif "forward" in self.query.data or "back" in self.query.data:
-            self.forward_or_back_handler(bot, update)
-        elif "answer" in self.query.data:
-            self.check_answer(bot, update)
-        elif "ok_cool" in self.query.data:
-            pass
+        query: CallbackQuery = update.callback_query
+        logger.debug("Button %s from %s", query.data, query.from_user.id)
+        if settings.click_rate and \
+                not click_limiter.allow(query.from_user.id):
+            outbound.submit(
+                bot.answerCallbackQuery, priority=PRIORITY_USER,
+                callback_query_id=query.id,
+                text=settings.strings["too_many_clicks"])
+            return
+        data = CallbackData.decode(query.data)
+        alert: str = None
+        if data is None or data.action not in self.actions or \
+                self.is_stale(query.from_user.id, data):
+            alert = settings.strings["stale_button"]
+        elif self.actions[data.action] is not None:
+            with user_lock(query.from_user.id):
+                alert = self.actions[data.action](bot, query, data)
+            with self._lock:
+                # the handlers used to answer the click themselves too.
+                self.answers_saved += 1
+        if alert:
+            outbound.submit(
+                bot.answerCallbackQuery, priority=PRIORITY_USER,
+                callback_query_id=query.id, text=alert, show_alert=True)
         else:
-            pass
-        bot.answerCallbackQuery(
-                callback_query_id=self.query.id)
+            outbound.submit(
+                bot.answerCallbackQuery, priority=PRIORITY_USER,
+                callback_query_id=query.id)
+
+    """
+    This method checks if a quiz button is from an older session than the
+    last one this user was seen with, nonces are the time the session was
+    made at, in hex. If the user wasn't seen yet, the scripts in Redis
+    check the nonce themselves.
+
+    returns: True or False
+    """
+    def is_stale(self, user_id: int, data: CallbackData) -> bool:
+        if data.action == "t" or not data.nonce:
+            return False
+        known = session_nonces.get(user_id)
+        try:
+            return known is not None and \
+                nonce_time(data.nonce) < nonce_time(known)
+        except ValueError:
+            return True
+
+    """
+    This method returns the counters of the API calls the buttons didn't
+    make: the second answer every click used to get, and the edits that
+    wouldn't have changed the message, in total and per quiz finished.
+
+    returns: dict
+    """
+    def stats(self) -> dict:
+        with self._lock:
+            saved = self.answers_saved + self.edits_skipped
+            return {"answers_saved": self.answers_saved,
+                    "edits_skipped": self.edits_skipped,
+                    "quizzes": self.quizzes,
+                    "saved_per_quiz": saved / self.quizzes
+                    if self.quizzes else 0}
+
+    """
+    This method handles the < and > buttons of the `/test` preview, the
+    range and the page are in the callback data, and so is the admin who
+    sent the `/test`, the buttons only work for them (everyone else gets
+    `[STRINGS]["stale_button"]`). If the bank got smaller
+    since the preview was sent, the pages of the questions it still has
+    are shown, with `[STRINGS]["test_bank_changed"]`.
+
+    returns: the alert to show, or None.
+    """
+    def test_page_handler(self, bot: Bot, query: CallbackQuery,
+                          data: CallbackData) -> str:
+        if query.from_user.id != data.question:
+            return settings.strings["stale_button"]
+        start_index, end_index = map(int, data.nonce.split("-"))
+        text, reply_markup = render_test_page(start_index, end_index,
+                                              data.index, data.question)
+        outbound.submit(
+            bot.editMessageText, priority=PRIORITY_USER,
+            chat_id=query.message.chat.id,
+            message_id=query.message.message_id,
+            text=text,
+            reply_markup=reply_markup,
+            parse_mode="HTML")
+        if end_index > len(quiz_bank):
+            return settings.strings["test_bank_changed"]
+        return None
 
     """
     When the user clicks on "Ready", this is the handler for that button.
+    It creates the user's session if there isn't one already, and shows
+    the question the user is at, unless the user failed and has to wait.
 
-    returns: None
+    returns: the alert to show, or None.
     """
-    def ready_handler(self, bot: Bot, update: Update) -> None:
-        user_id: int = self.query.from_user.id
-        name: str = f"user:questions:{user_id}"
-        rdb.setnx(name,
-                  json.dumps(random.sample(
-                                quizzes["quizzes"],
-                                int(config["GENERAL"]["questions_count"])),
-                             sort_keys=True))
-        rdb.hsetnx(f"user:{user_id}", "question", 0)
-        # no need to do it with my old shitty way
-        # i was just trying to make it work back then
-        # so...
-        # first question ;)
-        self.make_keyboard(bot, update)
+    def ready_handler(self, bot: Bot, query: CallbackQuery,
+                      data: CallbackData = None) -> str:
+        user_id: int = query.from_user.id
+        bank = quiz_bank
+        state = run_quiz_script(
+            ready_script, user_id,
+            [new_nonce(bank),
+             encode_session(bank.sample(settings.questions_count,
+                                        settings.quiz_stratify)),
+             settings.session_ttl, settings.user_ttl, user_id,
+             query.message.message_id])
+        if state.status == "missing":
+            # the session was dropped while converting it, make a new one.
+            state = run_quiz_script(
+                ready_script, user_id,
+                [new_nonce(bank),
+                 encode_session(bank.sample(settings.questions_count,
+                                            settings.quiz_stratify)),
+                 settings.session_ttl, settings.user_ttl, user_id,
+                 query.message.message_id])
+        if state.status == "wait":
+            return settings.strings["has_to_wait"]
+        return self.make_keyboard(bot, query, state)
+
+    """
+    This method drops the user's session and starts a new one, for the
+    sessions whose quiz bank isn't kept anymore (see `session_bank()`).
+
+    returns: the alert to show, or None.
+    """
+    def restart(self, bot: Bot, query: CallbackQuery) -> str:
+        user_id: int = query.from_user.id
+        rdb.delete(f"user:questions:{user_id}", f"user:results:{user_id}")
+        session_nonces.pop(user_id)
+        return self.ready_handler(bot, query)
 
     """
     This method is responsible for making the keyboard layout.
+    It doesn't touch the database, everything it needs is in `state`, and
+    the text of the question comes from `QuizBank.render()`, so only the
+    buttons are made on every click.
 
-    returns: None
+    The message isn't edited if the script says it already shows this
+    page (see LUA_SESSION), e.g. on "<" at the first question, Telegram
+    would only answer "message is not modified".
+
+    returns: None, there's no alert to show.
     """
-    def make_keyboard(self, bot: Bot, update: Update) -> None:
-        user_id: int = self.query.from_user.id
-        name: str = f"user:questions:{user_id}"
-        name_results: str = f"user:results:{user_id}"
-        user_questions = json.loads(rdb.get(name))
-        question_number = int(rdb.hget(f"user:{user_id}", "question"))
-        current_question = user_questions[question_number]
-        question_id = quizzes["quizzes"].index(current_question)
-        user_question_id = user_questions.index(current_question)
+    def make_keyboard(self, bot: Bot, query: CallbackQuery,
+                      state: QuizState) -> str:
+        bank = session_bank(state.nonce)
+        if bank is None:
+            return self.restart(bot, query)
+        user_id: int = query.from_user.id
+        question_id = state.question_id
         keyboard = [[], []]
-        rdb.hsetnx(
-            name=name_results,
-            key=user_question_id,
-            value="u")
-        chosen = rdb.hget(
-            name=name_results,
-            key=user_question_id).decode("utf-8")
-
-        text = f"<code>(ID: {question_id})</code>\n" \
-               f"{current_question['question']}\n"
+        session_nonces.set(user_id, state.nonce)
+        if not state.changed:
+            with self._lock:
+                self.edits_skipped += 1
+            return None
+        if state.chosen == "c":
+            choice = settings.strings["correct_choice"]
+        elif state.chosen == "w":
+            choice = settings.strings["wrong_choice"]
+        else:
+            choice = ""
+        text, labels = bank.render(question_id, choice)
 
         keyboard[1].append(InlineKeyboardButton(
-            "<", callback_data=f"back"))
+            "<", callback_data=CallbackData("b", state.nonce).encode()))
         keyboard[1].append(InlineKeyboardButton(
-            f"{question_number + 1}/{config['GENERAL']['questions_count']}",
-            callback_data=f"ok_cool"))
+            f"{state.index + 1}/{state.total}",
+            callback_data=CallbackData("n").encode()))
         keyboard[1].append(InlineKeyboardButton(
-            ">", callback_data=f"forward"))
-
-        # TODO: make this pretty.
-        if chosen == "u":
-            for option in current_question["options"]:
-                option_index = current_question["options"].index(option)
-                keyboard[0].append(InlineKeyboardButton(
-                    str(option_index),
-                    callback_data=f"answer:{user_question_id}:{option_index}",
-                    parse_mode="HTML"))
-                text += f"\n{option_index}) {option}"
-        elif chosen == "c" or chosen == "w":
-            for option in current_question["options"]:
-                option_index = current_question["options"].index(option)
-                text += f"\n{option_index}) {option}"
-            choice = config["STRINGS"]["correct_choice"] if chosen == "c" \
-                else config["STRINGS"]["wrong_choice"]
-            text += f"\n\n<i>{choice}</i>"
+            ">", callback_data=CallbackData("f", state.nonce).encode()))
+
+        if state.chosen == "u":
+            keyboard[0] = [InlineKeyboardButton(
+                label, callback_data=CallbackData(
+                    "a", state.nonce, state.index, question_id,
+                    option_index).encode())
+                for option_index, label in enumerate(labels)]
 
         kwargs = {
-            "chat_id": self.query.message.chat.id,
+            "chat_id": query.message.chat.id,
             "text": text,
             "reply_markup": InlineKeyboardMarkup(keyboard),
             "parse_mode": "HTML"}
 
-        # had this as one line, but flake8... :(
-        sendQuiz = bot.editMessageText
-        kwargs["message_id"] = self.query.message.message_id
-        sendQuiz(**kwargs)
-        bot.answerCallbackQuery(
-            callback_query_id=self.query.id)
+        kwargs["message_id"] = query.message.message_id
+        # if the edit fails, the next click tries it again.
+        outbound.submit(
+            bot.editMessageText, priority=PRIORITY_USER,
+            **kwargs).add_done_callback(
+                lambda future: future.exception() is not None and
+                rdb.hdel(f"user:{user_id}", "page"))
+        return None
 
     """
     This method is handles your > and < clicks (i.e. forward and back)
     However, the only thing it basically does it either increment your
-    current question_number or decrement it.
+    current question_number or decrement it, it never goes below the first
+    question.
 
     This means that:
     If you /start a quiz, and keep at, let's say, question number 4.
     Decide to /start another quiz for some reason, then it will start
     at the same question that you left unanswered, or just left it there.
 
-    If, let's say, it didn't start at the same question, it will start at 0,
-    and when you click > (forward), it will go to question number 5, since
-    left at 4.
-
     Keep in mind that this method only handles what's said above,
     self.make_keyboard is still the one responsible for making the layout.
-    This method just updates the Redis database, and calls self.make_keyboard.
-    It will also either restrict members and put them in the wait database
-    if they finished the questions and didn't score enough, or unrestrict
-    them.
 
-    returns: None
-    """
-    def forward_or_back_handler(self, bot: Bot, update: Update) -> None:
-        # TODO: this is very unstable and buggy, fix.
-        user_id: int = self.query.from_user.id
-        name: str = f"user:{user_id}"
-        question_number = int(rdb.hget(name, "question"))
-        max_number = int(config["GENERAL"]["questions_count"]) - 1
-        min_correct = int(config["GENERAL"]["correct_answers"])
-        if "forward" in self.query.data:
-            rdb.hincrby(name, "question", 1)
-        elif "back" in self.query.data:
-            rdb.hincrby(name, "question", -1)
-
-        if question_number > max_number:
-            rdb.hset(name, "question", -1)
-        elif question_number == max_number:
-            user_results = get_results(decode_dict(
-                rdb.hgetall(f"user:results:{user_id}")))
-            if user_results["u"] == 0:
-                if user_results["c"] >= min_correct:
-                    bot.answerCallbackQuery(
-                        callback_query_id=self.query.id,
-                        text=config["STRINGS"]["enough_correct"],
-                        show_alert=True)
-                    for chat_id in parse_list(config["CHATS"]["main_chats"]):
-                            bot.restrictChatMember(
-                                chat_id=chat_id,
-                                user_id=user_id,
-                                can_send_messages=True,
-                                can_send_media_messages=True,
-                                can_send_other_messages=True,
-                                can_add_web_page_previews=True)
-                else:
-                    rdb.setnx(f"user:wait:{user_id}", time.time())
-                    bot.answerCallbackQuery(
-                        callback_query_id=self.query.id,
-                        text=config["STRINGS"]["has_to_wait"],
-                        show_alert=True)
-            else:
-                bot.answerCallbackQuery(
-                        callback_query_id=self.query.id,
-                        text=config["STRINGS"]["unanswered_questions"],
-                        show_alert=True)
-            return
-        elif question_number < 0:
-            rdb.hincrby(name, "question", 1)
+    Clicking > on the last question finishes the quiz, it will either
+    unrestrict the user if they scored enough, or drop the session and put
+    them in the wait database (for `failed_user_wait` seconds) if they
+    didn't. Clicking > again after passing only shows the alert again.
+
+    All of it is done by one script in Redis, see LUA_NAVIGATE.
 
-        self.make_keyboard(bot, update)
+    returns: the alert to show, or None.
+    """
+    def forward_or_back_handler(self, bot: Bot, query: CallbackQuery,
+                                data: CallbackData) -> str:
+        user_id: int = query.from_user.id
+        step: int = 1 if data.action == "f" else -1
+        state = run_quiz_script(
+            navigate_script, user_id,
+            [data.nonce, step, settings.correct_answers, time.time(),
+             settings.failed_user_wait, user_id, query.message.message_id])
+
+        if state.status == "missing":
+            return self.ready_handler(bot, query)
+        elif state.status == "stale":
+            return settings.strings["stale_button"]
+        elif state.status == "finished":
+            return settings.strings["enough_correct"]
+        elif state.status in ("passed", "failed"):
+            with self._lock:
+                self.quizzes += 1
+            if state.status == "failed":
+                return settings.strings["has_to_wait"]
+            for chat_id in settings.main_chats:
+                outbound.submit(
+                    bot.restrictChatMember, priority=PRIORITY_USER,
+                    chat_id=chat_id,
+                    user_id=user_id,
+                    can_send_messages=True,
+                    can_send_media_messages=True,
+                    can_send_other_messages=True,
+                    can_add_web_page_previews=True)
+            return settings.strings["enough_correct"]
+        elif state.status == "unanswered":
+            return settings.strings["unanswered_questions"]
+        return self.make_keyboard(bot, query, state)
 
     """
     This method simply checks if the chosen answer is correct or not.
-    And then changes the database based on the results.
+    And then saves it, unless the question was answered already, in one
+    script in Redis, see LUA_ANSWER.
 
     It also calls self.make_keyboard() to set up the layout.
 
-    returns: None
+    returns: the alert to show, or None.
     """
-    def check_answer(self, bot: Bot, update: Update) -> None:
-        user_id: int = self.query.from_user.id
-        name: str = f"user:questions:{user_id}"
-        name_results: str = f"user:results:{user_id}"
-        answer_data = parse_list(self.query.data, splitter=":")
-        print(answer_data)
-        chosen = rdb.hget(
-            name=name_results,
-            key=answer_data[1]).decode("utf-8")
-        if chosen != "u":
-            bot.answerCallbackQuery(
-                callback_query_id=self.query.id,
-                text=config["STRINGS"]["already_chosen"],
-                show_alert=True)
-            return
-        else:
-            user_questions = json.loads(rdb.get(name))
-            current_question = user_questions[answer_data[1]]
-            choice_string = "c" if int(current_question["answer"]) \
-                == answer_data[2] else "w"
-            print(choice_string)
-            print(current_question)
-            rdb.hset(
-                name=name_results,
-                key=answer_data[1],
-                value=choice_string)
-            self.make_keyboard(bot, update)
+    def check_answer(self, bot: Bot, query: CallbackQuery,
+                     data: CallbackData) -> str:
+        user_id: int = query.from_user.id
+        question_id: int = data.question
+        if question_id == -1:
+            # buttons from before the question ID was in the callback data.
+            user_questions = load_session(user_id)
+            if user_questions is None:
+                return self.ready_handler(bot, query)
+            question_id = user_questions[data.index]
+        bank = session_bank(data.nonce)
+        if bank is None:
+            return self.restart(bot, query)
+        current_question = bank[question_id]
+        choice_string = "c" if int(current_question["answer"]) \
+            == data.option else "w"
+        state = run_quiz_script(
+            answer_script, user_id,
+            [data.nonce, data.index, question_id, choice_string,
+             bank.key(question_id), query.message.message_id])
+        if state.status == "missing":
+            return self.ready_handler(bot, query)
+        elif state.status == "stale":
+            return settings.strings["stale_button"]
+        elif state.status == "already":
+            return settings.strings["already_chosen"]
+        return self.make_keyboard(bot, query, state)
 
 
 class GateJobs(object):
     """Main class for PythonTalkTalk's jobs, this contains \
     only the jobs for the bot. I.e. doing $X every $Y"""
 
+    def __init__(self, seen_store: SeenStore = None):
+        self.seen_store = seen_store
+
+    """
+    This job polls the RSS feeds, see `FeedScheduler`, it runs every second
+    but only downloads the feeds that are due, and doesn't wait for them.
+
+    returns: None
+    """
+    def rss_scheduler(self, bot, job) -> None:
+        job.context.poll(
+            lambda feed, parsed: self.rss_reader(bot, feed, parsed))
+
     """
-    This method handles parsing the RSS feeds and doing stuff with them.
-    It can handle as many RSS feeds as you want, and it will save the data
-    for each different RSS in a special folder `rss` in src/data/rss
+    This method handles doing stuff with a parsed RSS feed, it posts the
+    entries that weren't posted before to every main chat.
 
-    This is done simply to know new entries. I can avoid doing this, but then
-    I'd have to store them in memory, which I might do later on, since I'm
-    using Redis anyways. This is just the rewritten version of the old source
-    code.
+    The entries that were posted are remembered in `self.seen_store`, see
+    `SeenStore`, by their GUID (or link).
 
     returns: None
     """
-    def rss_reader(self, bot, job) -> None:
-        args = job.context
-        feed = feedparser.parse(args["link"])
-        file_name = f"data/rss/{args['name']}_rss.txt"
-        try:
-            with open(file_name, "r+") as rss_file:
-                pass
-        except FileNotFoundError:
-            with open(file_name, "w") as rss_file:
-                pass
-        with open(file_name, "r+") as rss_file:
-            data = [line.rstrip("\n") for line in rss_file]
-            entries = [entry["title"] for entry in feed["entries"]]
-            new_entries = [entry for entry in entries
-                           if entry not in set(data)]
-            if len(new_entries) != 0:
-                final_message = f"RSS (registered name):" \
-                    f" <code>{args['name']}</code>" \
-                    f" [<code>ID {args['ID']}</code>]\n\n"
-                for entry in feed["entries"]:
-                    if entry["title"] in new_entries:
-                        final_message += (f"→ <a href=\"{entry['link']}\">"
-                                          f"{entry['title']}</a>\n")
-                    else:
-                        continue
-                for chat in parse_list(config["CHATS"]["main_chats"]):
-                    bot.sendMessage(
-                        chat_id=chat,
-                        text=final_message,
-                        parse_mode="HTML",
-                        disable_web_page_preview=True)
-            rss_file.seek(0)
-            rss_file.truncate()
-            rss_file.write("\n".join(entries))
+    def rss_reader(self, bot, feed: Feed, parsed) -> None:
+        entries = parsed["entries"]
+        if not feed.imported:
+            import_seen_file(self.seen_store, feed, entries)
+            feed.imported = True
+        keys = [entry_key(entry) for entry in entries]
+        new_entries = [(key, entry) for key, entry, seen
+                       in zip(keys, entries,
+                              self.seen_store.seen(feed.name, keys))
+                       if not seen]
+        if len(new_entries) != 0:
+            final_message = f"RSS (registered name):" \
+                f" <code>{feed.name}</code>" \
+                f" [<code>ID {feed.id}</code>]\n\n"
+            for _, entry in new_entries:
+                final_message += (f"→ <a href=\"{entry.get('link')}\">"
+                                  f"{entry.get('title')}</a>\n")
+            for chat in settings.main_chats:
+                outbound.submit(
+                    bot.sendMessage,
+                    chat_id=chat,
+                    text=final_message,
+                    parse_mode="HTML",
+                    disable_web_page_preview=True)
+            self.seen_store.add(feed.name, [key for key, _ in new_entries])
+
+    """
+    This method reloads `quizzes.json` if it changed, see
+    `reload_quiz_bank()`. It runs in every process of the bot.
+
+    returns: None
+    """
+    def reload_quiz_bank(self, bot, job) -> None:
+        reload_quiz_bank()
+
+    """
+    This method scans the next `[REDIS][compact_batch]` keys of the
+    database, see `KeyspaceCompactor`, which is in `job.context`.
+
+    returns: None
+    """
+    def compact_keys(self, bot, job) -> None:
+        job.context.step()
 
     """
     This method will check if there are any users who haven't sent `/start`
@@ -496,43 +3195,124 @@ class GateJobs(object):
 
     You can also configure how long it takes for the this job to run again.
 
+    The pending users are kept in the `users:start:deadlines` sorted set,
+    scored by the time they have to send `/start` by, so this only fetches
+    the users that are past their deadline, `[USER][check_sent_start_batch]`
+    at a time, no matter how many users are still pending.
+
     returns: None
     """
     def has_sent_start(self, bot, job) -> None:
-        current_time = time.time()
-        for from_id, start_time in rdb.hgetall("users:start").items():
-            if not is_digit(from_id) and not is_digit(start_time):
-                continue
-            from_id = int(from_id)
-            start_time = int(float(start_time))
-            if current_time - start_time < \
-                    int(config["USER"]["check_sent_start"]):
-                continue
-            for custom_chat in parse_list(config["CHATS"]["main_chats"]):
-                custom_chat = int(custom_chat)
-                bot.kickChatMember(
+        batch_size: int = settings.check_sent_start_batch
+        while True:
+            expired = rdb.zrangebyscore(
+                "users:start:deadlines", "-inf", time.time(),
+                start=0, num=batch_size)
+            if not expired:
+                return
+            pipe = rdb.pipeline()
+            for from_id in expired:
+                pipe.hget(f"user:{int(from_id)}", "username")
+            pipe.zrem("users:start:deadlines", *expired)
+            usernames = pipe.execute()[:-1]
+            self.kick_no_start_users(
+                bot,
+                {int(from_id): username.decode("utf-8") if username
+                 else int(from_id)
+                 for from_id, username in zip(expired, usernames)})
+            if len(expired) < batch_size:
+                return
+
+    """
+    This method kicks (and then unbans, so they can join again later) a
+    batch of users who haven't sent `/start` from every main chat, and
+    sends one log message per chat for the whole batch, if it's enabled.
+
+    The calls go through the outbound queue, so they're rate limited, and
+    nothing waits for them: every kick is followed up (the unban, and the
+    log messages after the last kick) from its future's callback, so the
+    job queue's thread is free for the other jobs in the meantime.
+
+    returns: None
+    """
+    def kick_no_start_users(self, bot, users: dict) -> None:
+        kicked: dict = {custom_chat: [] for custom_chat in settings.main_chats}
+        pending: list = [len(kicked) * len(users)]
+        lock = threading.Lock()
+
+        def kick_done(custom_chat: int, from_id: int, kick: Future) -> None:
+            try:
+                kick.result()
+            except Exception as err:
+                logger.warning("Couldn't kick %d from %d: %r",
+                               from_id, custom_chat, err)
+            else:
+                outbound.submit(
+                    bot.unbanChatMember,
                     chat_id=custom_chat,
                     user_id=from_id)
-                bot.unbanChatMember(
+                with lock:
+                    kicked[custom_chat].append(str(users[from_id]))
+            with lock:
+                pending[0] -= 1
+                if pending[0]:
+                    return
+            self.log_kicked(bot, kicked)
+
+        for custom_chat in settings.main_chats:
+            for from_id in users:
+                outbound.submit(
+                    bot.kickChatMember,
                     chat_id=custom_chat,
-                    user_id=from_id)
-                rdb.hdel("users:start", from_id)
-                if config["GENERAL"]["log_kick_no_start_user"] == "true":
-                    from_username = rdb.hget(
-                        f"user:{from_id}",
-                        "username").decode("utf-8")
-                    log_message = config["STRINGS"]["no_start"].format(
-                        username=from_username)
-                    bot.sendMessage(
-                        chat_id=custom_chat,
-                        text=log_message,
-                        parse_mode="Markdown")
+                    user_id=from_id).add_done_callback(
+                        lambda kick, custom_chat=custom_chat,
+                        from_id=from_id: kick_done(custom_chat, from_id,
+                                                   kick))
+
+    """
+    This method sends one log message to every main chat with the users
+    `kick_no_start_users()` kicked from it, if it's enabled.
+
+    returns: None
+    """
+    def log_kicked(self, bot, kicked: dict) -> None:
+        if not settings.log_kick_no_start_user:
+            return
+        for custom_chat, usernames in kicked.items():
+            if usernames:
+                log_message = settings.strings["no_start"].format(
+                    username=", ".join(usernames))
+                outbound.submit(
+                    bot.sendMessage,
+                    chat_id=custom_chat,
+                    text=log_message,
+                    parse_mode="Markdown")
 
 
 class GateCommands(object):
     """Main class for GateBot, this contains only \
     the main non-modular commands. Sorted alphabetically."""
 
+    def __init__(self):
+        self.test_runs: dict = {}
+
+    """
+    This method cancels the `/test` that's checking questions in the
+    background in this chat, if there's one.
+
+    returns: None
+    """
+    def cancel(self, bot: Bot, update: Update) -> None:
+        if is_admin(bot, update, update.message.from_user.id):
+            job = self.test_runs.pop(update.message.chat.id, None)
+            if job is not None:
+                job.schedule_removal()
+                update.message.reply_text(settings.strings["test_cancelled"])
+        else:
+            if settings.delete_commands:
+                bot.delete_message(chat_id=update.message.chat.id,
+                                   message_id=update.message.message_id)
+
     def config(self, bot: Bot, update: Update) -> None:
         pass
 
@@ -570,10 +3350,10 @@ class GateCommands(object):
                 pass
             else:
                 update.message.reply_text(
-                    text=config["STRINGS"]["failed_match"],
+                    text=settings.strings["failed_match"],
                     parse_mode="Markdown")
         else:
-            if config["GENERAL"]["delete_commands"] == "true":
+            if settings.delete_commands:
                 bot.delete_message(chat_id=update.message.chat.id,
                                    message_id=update.message.message_id)
 
@@ -581,210 +3361,471 @@ class GateCommands(object):
         pass
 
     """
-    This method handles banning multiple users only in the chat that the
-    command was used from. This will not ban other users if they were in
-    the [CHATS] section, "main_chats".
+    This method handles banning multiple users in the chat that the
+    command was used from, or in every chat from the [CHATS] section,
+    "main_chats", if the first argument is `all`, e.g.
+    `/lban all @username 1234567`. That only works in a main chat, and
+    only for the mods or the admins of every main chat, see `is_mod()`.
 
     If used as a reply to a message, it will only ban the user that sent
     the original message.
 
     If used as a normal command, then it will ban every single user used in
     the command, user with usernames have to be in the database, obviously.
-    This isn't really a good idea since people can change usernames, but
-    if you wanna do it, then I guess you can also do it this way.
+    They're all looked up at once, and user IDs are used as they are.
 
-    It will build up a nice log message telling you whether banning a
-    specific user was successful or not.
+    The bans go out concurrently through the outbound queue, and a log
+    message telling you whether banning a specific user was successful or
+    not is edited as they finish, see `format_ban_log()`. This runs in a
+    worker thread, so it doesn't hold up the other updates.
 
     returns: None
     """
+    @run_async
     def lban(self, bot: Bot, update: Update) -> None:
         from_id: int = update.message.from_user.id
-        message: str = update.message.text
-        if is_admin(bot, update, from_id) and len(message.split()) >= 2:
-            ids_to_ban: dict = {}
-            final_message = "<b>Banning log:</b>\n"
-            if update.message.reply_to_message:
-                reply_id = update.message.reply_to_message.from_user.id
-                ids_to_ban[reply_id] = update.message.reply_to_message.\
-                    from_user.username
-            else:
-                entities = update.message.parse_entities()
-                for entity in entities:
-                    mention = message[entity.offset:
-                                      entity.offset + entity.length]
-                    if entity.type == "mention":
-                        user_id = rdb.get(f"username:{mention[1:]}")
-                        if user_id != 0:
-                            ids_to_ban[user_id] = mention
-                    elif entity.type == "phone_number":
-                        try:
-                            from_user_id = bot.getChatMember(
-                                chat_id=update.message.chat.id,
-                                user_id=mention)
-                            ids_to_ban[from_user_id.user.id] = \
-                                from_user_id.user.first_name
-                        except error.BadRequest:
-                            continue
-                    elif entity.type == "text_mention":
-                        ids_to_ban[entity.user.id] = entity.user.first_name
-            for usr in ids_to_ban:
-                status: str = ""
-                log_msg = f"<code>{ids_to_ban[usr]} {'.'*5} {status}</code>\n"
-                try:
-                    bot.kickChatMember(
-                        chat_id=update.message.chat_id,
-                        user_id=usr)
-                    final_message += log_msg.format(status="OK")
-                except error.BadRequest:
-                    final_message += log_msg.format(status="FAIL")
-            bot.sendMessage(
+        words: list = update.message.text.split()
+        ban_all: bool = words[1:2] == ["all"]
+        if ban_all:
+            # it bans from every main chat, so only the mods (or the
+            # admins of all of them) can do it, from one of them.
+            allowed = update.message.chat_id in settings.main_chats and \
+                is_mod(bot, from_id)
+        else:
+            allowed = is_admin(bot, update, from_id)
+        if allowed and (len(words) >= 2 or update.message.reply_to_message):
+            chats = settings.main_chats if ban_all \
+                else [update.message.chat_id]
+            ids_to_ban, unknown = self.resolve_ban_targets(update)
+            kicks: dict = {
+                outbound.submit(
+                    bot.kickChatMember,
+                    chat_id=chat_id,
+                    user_id=usr): usr
+                for usr in ids_to_ban for chat_id in chats}
+            results: dict = {usr: [] for usr in ids_to_ban}
+            text = format_ban_log(ids_to_ban, results, len(chats), unknown)
+            log_message = outbound.submit(
+                bot.sendMessage,
                 chat_id=update.message.chat.id,
-                text=final_message,
-                parse_mode="HTML")
+                text=text,
+                parse_mode="HTML").result()
+            edit: Future = None
+            for kick in as_completed(kicks):
+                results[kicks[kick]].append(kick.exception() is None)
+                if edit is not None and not edit.done():
+                    continue
+                text = format_ban_log(ids_to_ban, results, len(chats),
+                                      unknown)
+                edit = self.edit_ban_log(bot, log_message, text)
+            final_text = format_ban_log(ids_to_ban, results, len(chats),
+                                        unknown)
+            if final_text != text:
+                if edit is not None:
+                    edit.exception()
+                self.edit_ban_log(bot, log_message, final_text)
         else:
-            if config["GENERAL"]["delete_commands"] == "true":
+            if settings.delete_commands:
                 bot.delete_message(chat_id=update.message.chat.id,
                                    message_id=update.message.message_id)
 
+    """
+    This method edits the `/lban` log message through the outbound queue.
+
+    returns: Future
+    """
+    def edit_ban_log(self, bot: Bot, log_message, text: str) -> Future:
+        return outbound.submit(
+            bot.editMessageText,
+            chat_id=log_message.chat_id,
+            message_id=log_message.message_id,
+            text=text,
+            parse_mode="HTML")
+
+    """
+    This method finds the users that `/lban` has to ban. The @usernames
+    are all resolved with one MGET (see `find_users()`), user IDs don't
+    need resolving.
+
+    returns: tuple, a dict of user IDs to their names for the log, and
+    a list of the @usernames that aren't in the database.
+    """
+    def resolve_ban_targets(self, update: Update) -> tuple:
+        message = update.message
+        if message.reply_to_message:
+            user = message.reply_to_message.from_user
+            return {user.id: user.username or user.first_name}, []
+        ids_to_ban: dict = {}
+        mentions: list = []
+        for entity, text in message.parse_entities().items():
+            if entity.type == "mention":
+                mentions.append(text)
+            elif entity.type == "text_mention":
+                ids_to_ban[entity.user.id] = entity.user.first_name
+        for word in message.text.split()[1:]:
+            if word.isdigit():
+                ids_to_ban[int(word)] = word
+        unknown: list = []
+        for mention, user_id in zip(mentions, find_users(mentions)):
+            if user_id is None:
+                unknown.append(mention)
+            else:
+                ids_to_ban[user_id] = mention
+        return ids_to_ban, unknown
+
     def remove(self, bot: Bot, update: Update) -> None:
         if is_admin(bot, update, update.message.from_user.id):
             pass
         else:
-            if config["GENERAL"]["delete_commands"] == "true":
+            if settings.delete_commands:
                 bot.delete_message(chat_id=update.message.chat.id,
                                    message_id=update.message.message_id)
 
     def start(self, bot: Bot, update: Update) -> None:
-        if update.message.chat_id not in parse_list(
-                config["CHATS"]["main_chats"]):
+        if update.message.chat_id not in settings.main_chats:
             from_id = update.message.from_user.id
             from_username = update.message.from_user.username
             name = f"user:{from_id}"
-            if from_username is not None:
-                rdb.hsetnx(name, "username", from_username)
-            if rdb.hget(name, "allowed") == "true":
-                update.message.reply_text(config["STRINGS"]["user_took_quiz"])
+            pipe = rdb.pipeline(transaction=False)
+            remember_users([update.message.from_user], pipe)
+            pipe.expire(name, settings.user_ttl)
+            pipe.zrem("users:start:deadlines", from_id)
+            pipe.sismember("users:allowed", from_id)
+            # users who passed before users:allowed, until they're moved.
+            pipe.hget(name, "allowed")
+            *_, allowed, legacy_allowed = pipe.execute()
+            if allowed or legacy_allowed == b"true":
+                update.message.reply_text(settings.strings["user_took_quiz"])
             else:
                 keyboard = [[InlineKeyboardButton(
-                        config["STRINGS"]["ready"],
-                        callback_data="ready")]]
+                        settings.strings["ready"],
+                        callback_data=CallbackData("r").encode())]]
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 update.message.reply_text(
-                    config["STRINGS"]["start_message"].format(
+                    settings.strings["start_message"].format(
                         username=from_username,
-                        start=config["COMMANDS"]["start"],
-                        correct_answers=config["GENERAL"]["correct_answers"],
-                        questions_count=config["GENERAL"]["questions_count"]),
+                        start=settings.commands["start"],
+                        correct_answers=settings.correct_answers,
+                        questions_count=settings.questions_count),
                     parse_mode="Markdown",
                     reply_markup=reply_markup)
         else:
-            if config["GENERAL"]["send_start_no"] == "true":
-                update.message.reply_text(config["STRINGS"]["no"])
-            if config["GENERAL"]["delete_commands"] == "true":
+            if settings.send_start_no:
+                update.message.reply_text(settings.strings["no"])
+            if settings.delete_commands:
+                bot.delete_message(chat_id=update.message.chat.id,
+                                   message_id=update.message.message_id)
+
+    """
+    This method shows the quiz analytics, i.e. the pass rate, how long the
+    quizzes took and the questions most users get wrong, see
+    `format_quiz_stats()`. They're counted by the quiz scripts as users
+    take the quiz, so reading them is one round trip to Redis.
+
+    They're about every main chat, so only the mods can see them, see
+    `is_mod()`.
+
+    returns: None
+    """
+    def stats(self, bot: Bot, update: Update) -> None:
+        if is_mod(bot, update.message.from_user.id):
+            update.message.reply_text(format_quiz_stats(load_quiz_stats()),
+                                      parse_mode="HTML")
+        else:
+            if settings.delete_commands:
                 bot.delete_message(chat_id=update.message.chat.id,
                                    message_id=update.message.message_id)
 
-    def test(self, bot: Bot, update: Update) -> None:
+    """
+    This method previews the questions, e.g. `/test 10-50` (or just `/test`
+    for all of them), as one message with pages that you go through with
+    the < and > buttons, see `render_test_page()`.
+
+    At most `[GENERAL][test_max_range]` questions can be tested at once.
+    If there's more than one page of them, they're also all checked in the
+    background, `[GENERAL][test_batch_size]` every `[GENERAL][test_delay]`
+    seconds, and the problems are reported when it's done. `/cancel` stops
+    that.
+
+    returns: None
+    """
+    def test(self, bot: Bot, update: Update, job_queue) -> None:
         if is_admin(bot, update, update.message.from_user.id):
             command = update.message.text.split()
             start_index: int = 0
-            end_index: int = -1
+            end_index: int = len(quiz_bank)
             syntax = command[1].split("-") if len(command) == 2 else None
-            if is_digit(syntax[0]) and is_digit(syntax[1]):
+            if syntax and len(syntax) == 2 and \
+                    is_digit(syntax[0]) and is_digit(syntax[1]):
                 start_index = int(syntax[0])
                 end_index = int(syntax[1])
-            for question in quizzes["quizzes"][start_index:end_index]:
-                text = f'<code>(ID: {quizzes["quizzes"].index(question)})' \
-                    f'</code>\n{question["question"]}\n'
-                text += "\n".join(question["options"])
-                text += "\nAnswer: " + str(question["answer"])
-                update.message.reply_text(text, parse_mode="HTML")
-                time.sleep(int(config["GENERAL"]["test_delay"]))
+            question_ids = range(len(quiz_bank))[start_index:end_index]
+            question_ids = question_ids[:settings.test_max_range]
+            text, reply_markup = render_test_page(
+                question_ids.start, question_ids.stop, 0,
+                update.message.from_user.id)
+            message = update.message.reply_text(
+                text, parse_mode="HTML", reply_markup=reply_markup)
+            if len(question_ids) <= settings.test_page_size:
+                return
+            old_job = self.test_runs.pop(update.message.chat.id, None)
+            if old_job is not None:
+                old_job.schedule_removal()
+            status = update.message.reply_text(
+                settings.strings["test_running"].format(
+                    count=len(question_ids)))
+            self.test_runs[update.message.chat.id] = job_queue.run_repeating(
+                instrument("job", "test_batch", self.test_batch),
+                interval=settings.test_delay,
+                first=0,
+                context=TestRun(message.chat.id, status.message_id,
+                                question_ids))
         else:
-            if config["GENERAL"]["delete_commands"] == "true":
+            if settings.delete_commands:
                 bot.delete_message(chat_id=update.message.chat.id,
                                    message_id=update.message.message_id)
 
+    """
+    This is the job that checks the questions of a `/test` in the
+    background, one batch at a time, and then edits its status message
+    with the problems it found.
+
+    returns: None
+    """
+    def test_batch(self, bot: Bot, job) -> None:
+        run: TestRun = job.context
+        batch = run.question_ids[run.position:
+                                 run.position + settings.test_batch_size]
+        for question_id in batch:
+            if question_id >= len(quiz_bank):
+                # the bank got smaller while it was being checked.
+                break
+            problem = check_question(quiz_bank[question_id])
+            if problem is not None:
+                run.problems.append(f"<code>(ID: {question_id})</code> "
+                                    f"{problem}")
+        run.position += len(batch)
+        if run.position < len(run.question_ids):
+            return
+        job.schedule_removal()
+        if self.test_runs.get(run.chat_id) is job:
+            del self.test_runs[run.chat_id]
+        text = settings.strings["test_done"].format(
+            count=len(run.question_ids), problems=len(run.problems))
+        if run.problems:
+            text += "\n\n" + "\n".join(run.problems[:50])
+        outbound.submit(
+            bot.editMessageText,
+            chat_id=run.chat_id,
+            message_id=run.message_id,
+            text=text,
+            parse_mode="HTML")
+
     def version(self, bot: Bot, update: Update) -> None:
         update.message.reply_text(__version__)
 
 
-def main():
-    updater: Updater = Updater(config["BOT"]["bot_token"],
-                               request_kwargs={"read_timeout": 6,
-                                               "connect_timeout": 7})
+def create_app(config: str = None, instance: str = None) -> tuple:
+    """
+    This function is the application factory. It sets the bot up (see
+    `setup()`), then builds its updater with every handler and job, and
+    the leader lease in cluster mode. Nothing is started or sent yet,
+    `main()` does that. The RSS feeds (and feedparser) are only set up
+    if RSS is enabled.
+
+    returns: (Updater, LeaderLease or None)
+    """
+    setup(config)
+    lease = None
+    if settings.cluster:
+        instance = instance or settings.cluster_instance or \
+            f"{socket.gethostname()}:{os.getpid()}"
+        lease = LeaderLease(rdb, "leader:jobs", settings.lease_ttl, instance)
+        if settings.allow_rss and settings.rss_seen_store == "memory":
+            logger.warning("rss_seen_store is memory, RSS entries will be "
+                           "posted again when the leader changes.")
+
+    # the outbound queue's workers share the bot's connections too.
+    request: Request = (InstrumentedRequest if metrics.enabled else Request)(
+        con_pool_size=settings.workers + settings.send_workers + 4,
+        read_timeout=6,
+        connect_timeout=7)
+    updater: Updater = Updater(bot=Bot(settings.bot_token, request=request),
+                               workers=settings.workers)
     gate_buttons: GateButtons = GateButtons()
     gate_commands: GateCommands = GateCommands()
-    gate_jobs: GateJobs = GateJobs()
+    gate_jobs: GateJobs = GateJobs(
+        SEEN_STORES[settings.rss_seen_store](settings.rss_seen_window)
+        if settings.allow_rss else None)
     gate_handlers: GateHandlers = GateHandlers()
 
     dispatcher = updater.dispatcher
     # TODO: fix this, not okay.
     dispatcher.add_handler(CommandHandler(
-              config["COMMANDS"]["config"],
-              gate_commands.config))
+              settings.commands["cancel"],
+              instrument("handler", "cancel", gate_commands.cancel)))
+    dispatcher.add_handler(CommandHandler(
+              settings.commands["config"],
+              instrument("handler", "config", gate_commands.config)))
+    dispatcher.add_handler(CommandHandler(
+              settings.commands["edit"],
+              instrument("handler", "edit", gate_commands.edit)))
     dispatcher.add_handler(CommandHandler(
-              config["COMMANDS"]["edit"],
-              gate_commands.edit))
+              settings.commands["extra"],
+              instrument("handler", "extra", gate_commands.extra)))
     dispatcher.add_handler(CommandHandler(
-              config["COMMANDS"]["extra"],
-              gate_commands.extra))
+              settings.commands["help"],
+              instrument("handler", "help", gate_commands.help)))
     dispatcher.add_handler(CommandHandler(
-              config["COMMANDS"]["help"],
-              gate_commands.help))
+              settings.commands["lban"],
+              instrument("handler", "lban", gate_commands.lban)))
     dispatcher.add_handler(CommandHandler(
-              config["COMMANDS"]["lban"],
-              gate_commands.lban))
+              settings.commands["remove"],
+              instrument("handler", "remove", gate_commands.remove)))
     dispatcher.add_handler(CommandHandler(
-              config["COMMANDS"]["remove"],
-              gate_commands.remove))
+              settings.commands["start"],
+              instrument("handler", "start", gate_commands.start)))
     dispatcher.add_handler(CommandHandler(
-              config["COMMANDS"]["start"],
-              gate_commands.start))
+              settings.commands["stats"],
+              instrument("handler", "stats", gate_commands.stats)))
     dispatcher.add_handler(CommandHandler(
-              config["COMMANDS"]["test"],
-              gate_commands.test))
+              settings.commands["test"],
+              instrument("handler", "test", gate_commands.test),
+              pass_job_queue=True))
     dispatcher.add_handler(CommandHandler(
-              config["COMMANDS"]["version"],
-              gate_commands.version))
-    dispatcher.add_handler(CallbackQueryHandler(gate_buttons.diverter))
+              settings.commands["version"],
+              instrument("handler", "version", gate_commands.version)))
+    dispatcher.add_handler(CallbackQueryHandler(
+        instrument("handler", "diverter", gate_buttons.diverter)))
     dispatcher.add_handler(MessageHandler(
         Filters.status_update,
-        gate_handlers.new_status))
+        instrument("handler", "new_status", gate_handlers.new_status),
+        pass_job_queue=True))
+    # in its own group, so it sees every group message, commands too.
+    dispatcher.add_handler(MessageHandler(
+        Filters.group,
+        instrument("handler", "remember_sender",
+                   gate_handlers.remember_sender)), group=1)
 
     jobs = dispatcher.job_queue
     counter_ID: int = 0
 
-    if config["GENERAL"]["check_if_user_start"] != "true":
+    if not settings.check_if_user_start:
         pass
     else:
         jobs.run_repeating(
-            gate_jobs.has_sent_start,
-            interval=int(config["USER"]["check_sent_start_interval"]),
-            first=int(config["USER"]["check_sent_start_first"]))
+            leader_only(instrument(
+                "job", "has_sent_start", gate_jobs.has_sent_start), lease),
+            interval=settings.check_sent_start_interval,
+            first=settings.check_sent_start_first)
+
+    if settings.quiz_reload_interval:
+        jobs.run_repeating(
+            instrument("job", "reload_quiz_bank", gate_jobs.reload_quiz_bank),
+            interval=settings.quiz_reload_interval,
+            first=settings.quiz_reload_interval)
+
+    compactor = KeyspaceCompactor(settings.compact_batch)
+    if settings.compact_interval:
+        jobs.run_repeating(
+            leader_only(instrument(
+                "job", "compact_keys", gate_jobs.compact_keys), lease),
+            interval=settings.compact_interval,
+            first=settings.compact_interval,
+            context=compactor)
 
-    if config["GENERAL"]["allow_rss"] != "true":
+    if not settings.allow_rss:
         pass
     else:
-        rss_jobs = [config["RSS"][rss_job] for rss_job in config["RSS"]
-                    if config["RSS"] != [] and rss_job != ""]
-        for rss_job in rss_jobs:
-            parsed = parse_rss(rss_job)
-            jobs.run_repeating(
-                gate_jobs.rss_reader,
-                interval=parsed["interval"],
-                first=parsed["first"],
-                context={"link": parsed["link"],
-                         "name": rss_job,
-                         "ID": counter_ID})
+        feeds: list = []
+        for rss_name, rss_job in settings.rss.items():
+            feeds.append(Feed(counter_ID, rss_name, **parse_rss(rss_job)))
             counter_ID += 1
+        jobs.run_repeating(
+            leader_only(instrument(
+                "job", "rss_scheduler", gate_jobs.rss_scheduler), lease),
+            interval=1,
+            first=0,
+            context=FeedScheduler(
+                feeds,
+                workers=settings.rss_workers,
+                timeout=settings.rss_timeout,
+                max_backoff=settings.rss_max_backoff))
+
+    if metrics.enabled:
+        metrics.collectors.append(lambda: [
+            ("gatebot_admin_cache", {"stat": name}, value)
+            for name, value in admin_cache.stats().items()])
+        metrics.collectors.append(lambda: [
+            ("gatebot_outbound", {"stat": name}, value)
+            for name, value in outbound.stats().items()])
+        metrics.collectors.append(lambda: [
+            ("gatebot_buttons", {"stat": name}, value)
+            for name, value in gate_buttons.stats().items()])
+        metrics.collectors.append(lambda: [
+            ("gatebot_clicks", {"stat": name}, value)
+            for name, value in click_limiter.stats().items()])
+        metrics.collectors.append(lambda: [
+            (name, {"prefix": prefix}, counts[position])
+            for prefix, counts in compactor.report.items()
+            for position, name in enumerate(
+                ("gatebot_keys", "gatebot_keys_without_ttl"))] + [
+            ("gatebot_compacted_keys", {}, compactor.compacted)])
+    return updater, lease
+
+
+def main():
+    arguments = argparse.ArgumentParser(description="A Telegram gate bot.")
+    arguments.add_argument(
+        "--config",
+        help=f"the config file, instead of {config_file}")
+    arguments.add_argument(
+        "--port", type=int,
+        help="the port of the webhook, instead of [WEBHOOK][port]")
+    arguments.add_argument(
+        "--instance",
+        help="the name of this process, instead of [CLUSTER][instance]")
+    args = arguments.parse_args()
 
-    if config["GENERAL"]["enable_webhook"] == "true":
-        updater.start_webhook(**parse_dict(config["WEBHOOK"]))
+    try:
+        updater, lease = create_app(args.config, args.instance)
+    except FileNotFoundError:
+        print("Are you sure the config file is there? \
+            This is read as an empty file!")
+        sys.exit(0)
+    except (KeyError, ValueError, configparser.Error) as err:
+        # KeyError's message is quoted, the others' aren't.
+        logger.error("%s is broken: %s", config_file,
+                     err.args[0] if isinstance(err, KeyError) else err)
+        sys.exit(1)
+    migrate_sessions()
+    migrate_pending_starts()
+
+    if metrics.enabled:
+        metrics.serve(settings.metrics_listen, settings.metrics_port)
+
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, reload_settings)
+
+    if lease is not None:
+        lease.start(settings.lease_renew)
+
+    if settings.enable_webhook:
+        webhook = dict(settings.webhook)
+        if args.port is not None:
+            webhook["port"] = args.port
+        updater.start_webhook(**webhook)
+        if webhook["cert"] is None and webhook["webhook_url"] is not None:
+            # TLS is done by a proxy in front of the bot (and maybe of many
+            # processes of it), so the library doesn't set the webhook.
+            updater.bot.setWebhook(url=webhook["webhook_url"])
     else:
         updater.start_polling()
     updater.idle()
+    outbound.drain(timeout=10)
+
+    if lease is not None:
+        lease.stop()
 
 
 if __name__ == "__main__":